@@ -0,0 +1,115 @@
+import os
+import uuid
+import random
+import argparse
+
+# Namespaces as used in TCGA BCR clinical XML files
+NAMESPACES = {
+    "admin": "http://tcga.nci/bcr/xml/administration/2.7",
+    "shared": "http://tcga.nci/bcr/xml/shared/2.7",
+    "clin_shared": "http://tcga.nci/bcr/xml/clinical/shared/2.7",
+    "shared_stage": "http://tcga.nci/bcr/xml/clinical/shared/stage/2.7",
+    "brca": "http://tcga.nci/bcr/xml/clinical/brca/2.7",
+    "rx": "http://tcga.nci/bcr/xml/clinical/pharmaceutical/2.7",
+    "xsi": "http://www.w3.org/2001/XMLSchema-instance",
+}
+
+HISTOLOGICAL_TYPES = ["Infiltrating Ductal Carcinoma", "Infiltrating Lobular Carcinoma", "Mixed Histology (please specify)", "Other, specify"]
+STAGES = ["Stage I", "Stage IA", "Stage II", "Stage IIA", "Stage IIB", "Stage III", "Stage IIIA", "Stage IV"]
+
+def stable_uuid(kind, index):
+    """
+    Return a UUID that is the same for the same kind and index on every run
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, "gdc-tools-benchmark/%s/%d" % (kind, index)))
+
+def element(ns, tag, value, available=True):
+    """
+    Return a BCR element, or an empty nil element for values that are not available
+    """
+    if not available or value is None:
+        return '<%s:%s procurement_status="Not Available" owner="TSS" xsi:nil="true"/>' % (ns, tag)
+    return '<%s:%s procurement_status="Completed" owner="TSS">%s</%s:%s>' % (ns, tag, value, ns, tag)
+
+def make_bcr_xml(index, case_id=None, file_id=None, drugs=2):
+    """
+    Return a synthetic TCGA BCR clinical XML document for patient number index. The same
+    index always gives the same document. Every patient has the fields gdc_xml_parser keeps,
+    and drugs follow-up records that it has to skip, which control the size of the file.
+    """
+    rng = random.Random(index)
+    case_id = case_id or stable_uuid("case", index)
+    file_id = file_id or stable_uuid("clinical", index)
+    dead = rng.random() < 0.3
+    days_to_last_followup = rng.randint(30, 4000)
+
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>']
+    lines.append('<brca:tcga_bcr %s schemaVersion="2.7">' % " ".join('xmlns:%s="%s"' % (k, v) for k, v in sorted(NAMESPACES.items())))
+    lines.append('  <admin:admin>')
+    lines.append('    ' + element("admin", "bcr", "Nationwide Children's Hospital"))
+    lines.append('    ' + element("admin", "file_uuid", file_id))
+    lines.append('    ' + element("admin", "disease_code", "BRCA"))
+    lines.append('    ' + element("admin", "day_of_dcc_upload", rng.randint(1, 28)))
+    lines.append('  </admin:admin>')
+    lines.append('  <brca:patient>')
+    lines.append('    ' + element("shared", "bcr_patient_uuid", case_id.upper()))
+    lines.append('    ' + element("shared", "patient_id", "%04X" % (index % 65536)))
+    lines.append('    ' + element("shared", "gender", rng.choice(["FEMALE", "MALE"])))
+    lines.append('    ' + element("clin_shared", "vital_status", "Dead" if dead else "Alive"))
+    lines.append('    ' + element("clin_shared", "days_to_birth", -rng.randint(9000, 32000)))
+    lines.append('    ' + element("clin_shared", "days_to_death", rng.randint(10, days_to_last_followup), dead))
+    lines.append('    ' + element("clin_shared", "days_to_last_followup", days_to_last_followup, not dead))
+    lines.append('    ' + element("clin_shared", "days_to_initial_pathologic_diagnosis", 0))
+    lines.append('    ' + element("clin_shared", "age_at_initial_pathologic_diagnosis", rng.randint(26, 90)))
+    lines.append('    ' + element("shared", "histological_type", rng.choice(HISTOLOGICAL_TYPES)))
+    lines.append('    ' + element("shared", "diagnosis", None, False))
+    lines.append('    <shared_stage:stage_event system="AJCC">')
+    lines.append('      ' + element("shared_stage", "pathologic_stage", rng.choice(STAGES)))
+    lines.append('      <shared_stage:tnm_categories>')
+    lines.append('        <shared_stage:pathologic_categories>')
+    lines.append('          ' + element("shared_stage", "pathologic_T", "T%d" % rng.randint(1, 4)))
+    lines.append('          ' + element("shared_stage", "pathologic_N", "N%d" % rng.randint(0, 3)))
+    lines.append('          ' + element("shared_stage", "pathologic_M", "M%d" % rng.randint(0, 1)))
+    lines.append('        </shared_stage:pathologic_categories>')
+    lines.append('      </shared_stage:tnm_categories>')
+    lines.append('    </shared_stage:stage_event>')
+    lines.append('    <rx:drugs>')
+    for i in range(drugs):
+        lines.append('      <rx:drug>')
+        lines.append('        ' + element("rx", "bcr_drug_uuid", stable_uuid("drug-%d" % index, i)))
+        lines.append('        ' + element("rx", "drug_name", rng.choice(["Tamoxifen", "Anastrozole", "Doxorubicin", "Cyclophosphamide", "Paclitaxel"])))
+        lines.append('        ' + element("rx", "therapy_types", "Chemotherapy"))
+        lines.append('        ' + element("rx", "days_to_drug_therapy_start", rng.randint(0, 400)))
+        lines.append('        ' + element("rx", "days_to_drug_therapy_end", rng.randint(400, 900)))
+        lines.append('        ' + element("rx", "measure_of_response", None, False))
+        lines.append('      </rx:drug>')
+    lines.append('    </rx:drugs>')
+    lines.append('  </brca:patient>')
+    lines.append('</brca:tcga_bcr>')
+    return "\n".join(lines) + "\n"
+
+def write_xml_files(output_dir, num_files, drugs=2):
+    """
+    Write num_files synthetic BCR XML files to output_dir. Returns their paths.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    paths = []
+    for i in range(num_files):
+        path = os.path.join(output_dir, "nationwidechildrens.org_clinical.%s.xml" % stable_uuid("case", i))
+        with open(path, "wb") as f:
+            f.write(make_bcr_xml(i, drugs=drugs))
+        paths.append(path)
+    return paths
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write synthetic TCGA BCR clinical XML files.")
+    parser.add_argument("-o", "--output-dir", help="Directory to write XML files to.", required=True)
+    parser.add_argument("-n", "--num-files", help="Number of XML files. Default: 1000", type=int, default=1000)
+    parser.add_argument("--drugs", help="Number of drug records per patient, which controls the file size. Default: 2", type=int, default=2)
+    args = parser.parse_args(argv)
+    write_xml_files(args.output_dir, args.num_files, args.drugs)
+    print "Wrote %d XML files to %s" % (args.num_files, args.output_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+import io
+import gzip
+import json
+import time
+import hashlib
+import tarfile
+import argparse
+import threading
+import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import bcr_xml
+
+# Filter fields as the tools send them, mapped to the fields of a file in the dataset
+FIELD_ALIASES = {
+    "files.file_id": "file_id",
+    "files.file_name": "file_name",
+    "files.data_category": "data_category",
+    "files.data_format": "data_format",
+    "cases.case_id": "case_id",
+    "cases.project.primary_site": "primary_site",
+    "cases.diagnoses.vital_status": "vital_status",
+}
+
+# Fields with an index, so "in" filters with large lists don't have to scan every file
+INDEXED_FIELDS = ["file_id", "file_name", "case_id"]
+
+class Dataset(object):
+    """
+    Synthetic GDC data: num_cases cases, each with bams_per_case BAM files and one clinical
+    XML file. IDs are stable between runs, and XML documents are generated on request.
+    """
+
+    def __init__(self, num_cases, bams_per_case=2, drugs=2):
+        self.drugs = drugs
+        self.files = []
+        self.case_ids = []
+        self.case_files = {}
+        for i in range(num_cases):
+            case_id = bcr_xml.stable_uuid("case", i)
+            self.case_ids.append(case_id)
+            case_files = []
+            for j in range(bams_per_case + 1):
+                clinical = j == bams_per_case
+                if clinical:
+                    file_id = bcr_xml.stable_uuid("clinical", i)
+                    file_name = "nationwidechildrens.org_clinical.%s.xml" % case_id
+                else:
+                    file_id = bcr_xml.stable_uuid("bam-%d" % j, i)
+                    file_name = "%s_gdc_realn_rehead.bam" % file_id.replace("-", "")[:20]
+                f = {
+                    "index": len(self.files),
+                    "case_index": i,
+                    "file_id": file_id,
+                    "file_name": file_name,
+                    "case_id": case_id,
+                    "md5sum": hashlib.md5(file_id).hexdigest(),
+                    "file_size": 20000 + i if clinical else 5000000000 + i,
+                    "state": "released",
+                    "data_category": "Clinical" if clinical else "Raw Sequencing Data",
+                    "data_format": "BCR XML" if clinical else "BAM",
+                    "experimental_strategy": None if clinical else "RNA-Seq",
+                    "primary_site": "Breast",
+                    "vital_status": "dead" if i % 3 == 0 else "alive",
+                }
+                self.files.append(f)
+                case_files.append(f)
+            self.case_files[case_id] = case_files
+
+        # Results of recent filters, so paging through a search doesn't select every page again
+        self.selections = {}
+        self.lock = threading.Lock()
+
+        self.index = dict((field, {}) for field in INDEXED_FIELDS)
+        for f in self.files:
+            for field in INDEXED_FIELDS:
+                self.index[field].setdefault(f[field], []).append(f)
+
+    def content(self, f):
+        return bcr_xml.make_bcr_xml(f["case_index"], f["case_id"], f["file_id"], self.drugs)
+
+    def compile(self, flt):
+        """
+        Turn a GDC filter into a predicate on files. Value lists become sets once, up front.
+        """
+        op = flt["op"]
+        if op in ("and", "or"):
+            predicates = [self.compile(c) for c in flt["content"]]
+            if op == "and":
+                return lambda f: all(p(f) for p in predicates)
+            return lambda f: any(p(f) for p in predicates)
+
+        field = FIELD_ALIASES.get(flt["content"]["field"], flt["content"]["field"])
+        value = flt["content"]["value"]
+        values = set(str(v).lower() for v in (value if isinstance(value, list) else [value]))
+        def field_value(f):
+            return str(f.get(field)).lower()
+        if op in ("=", "in"):
+            return lambda f: f.get(field) is None or field_value(f) in values
+        if op == "exclude":
+            return lambda f: field_value(f) not in values
+        if op in (">", ">=", "<", "<="):
+            limit = float(list(values)[0])
+            compare = {">": float.__gt__, ">=": float.__ge__, "<": float.__lt__, "<=": float.__le__}[op]
+            return lambda f: f.get(field) is None or compare(float(f[field]), limit)
+        return lambda f: True
+
+    def candidates(self, flt):
+        """
+        Return the files that can match a filter according to an index, in dataset order,
+        or None if the filter can't use an index
+        """
+        op = flt["op"]
+        if op == "and":
+            for c in flt["content"]:
+                found = self.candidates(c)
+                if found is not None:
+                    return found
+            return None
+        if op not in ("=", "in"):
+            return None
+        field = FIELD_ALIASES.get(flt["content"]["field"], flt["content"]["field"])
+        if field not in self.index:
+            return None
+        value = flt["content"]["value"]
+        found = {}
+        for v in (value if isinstance(value, list) else [value]):
+            for f in self.index[field].get(v, []):
+                found[f["index"]] = f
+        return [found[i] for i in sorted(found)]
+
+    def select(self, flt):
+        """
+        Return the files matching a filter, in dataset order
+        """
+        if not flt:
+            return self.files
+        key = json.dumps(flt, sort_keys=True)
+        with self.lock:
+            if key in self.selections:
+                return self.selections[key]
+        predicate = self.compile(flt)
+        found = self.candidates(flt)
+        selection = [f for f in (self.files if found is None else found) if predicate(f)]
+        with self.lock:
+            if len(self.selections) >= 16:
+                self.selections.clear()
+            self.selections[key] = selection
+        return selection
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def read_params(self):
+        url = urlparse.urlparse(self.path)
+        params = dict((k, v[0]) for k, v in urlparse.parse_qs(url.query).items())
+        length = int(self.headers.get("content-length", 0))
+        if length:
+            params.update(json.loads(self.rfile.read(length)))
+        return url.path, params
+
+    def send_body(self, status, body, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.mock.bytes_sent += len(body)
+
+    def send_json(self, obj):
+        self.send_body(200, json.dumps(obj), {"Content-Type": "application/json"})
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        mock = self.server.mock
+        start = time.time()
+        path, params = self.read_params()
+        if mock.latency:
+            time.sleep(mock.latency)
+        try:
+            if path.endswith("/files"):
+                self.handle_files(params)
+            elif path.endswith("/cases"):
+                self.handle_cases(params)
+            elif path.endswith("/manifest"):
+                self.handle_manifest(params)
+            elif path.endswith("/data"):
+                self.handle_data(params)
+            else:
+                self.send_body(404, "Not found")
+        finally:
+            mock.record(path.rsplit("/", 1)[-1], time.time() - start)
+
+    def page(self, params, hits):
+        mock = self.server.mock
+        size = int(params.get("size", 10))
+        if mock.max_page_size:
+            size = min(size, mock.max_page_size)
+        offset = int(params.get("from", 0))
+        page = hits[offset:offset + size]
+        return page, {"total": len(hits), "from": offset, "size": size, "count": len(page)}
+
+    def filters(self, params):
+        flt = params.get("filters")
+        if isinstance(flt, basestring):
+            flt = json.loads(flt)
+        return flt
+
+    def handle_files(self, params):
+        dataset = self.server.mock.dataset
+        files = dataset.select(self.filters(params))
+        if params.get("facets"):
+            aggregations = {}
+            for facet in params["facets"].split(","):
+                field = FIELD_ALIASES.get(facet, facet)
+                counts = {}
+                for f in files:
+                    if f.get(field) is not None:
+                        counts[f[field]] = counts.get(f[field], 0) + 1
+                aggregations[facet] = {"buckets": [{"key": k, "doc_count": v} for k, v in sorted(counts.items())]}
+            return self.send_json({"data": {"hits": [], "aggregations": aggregations, "pagination": {"total": len(files), "from": 0, "size": 0, "count": 0}}, "warnings": {}})
+
+        page, pagination = self.page(params, files)
+        hits = []
+        for f in page:
+            hit = dict((k, f[k]) for k in ("file_id", "file_name", "md5sum", "file_size", "state", "data_category", "data_format"))
+            hit["cases"] = [{"case_id": f["case_id"]}]
+            hits.append(hit)
+        self.send_json({"data": {"hits": hits, "pagination": pagination}, "warnings": {}})
+
+    def handle_cases(self, params):
+        dataset = self.server.mock.dataset
+        case_ids = []
+        seen = set()
+        for f in dataset.select(self.filters(params)):
+            if f["case_id"] not in seen:
+                seen.add(f["case_id"])
+                case_ids.append(f["case_id"])
+        page, pagination = self.page(params, case_ids)
+        hits = []
+        for case_id in page:
+            files = [dict((k, f[k]) for k in ("file_id", "file_name", "data_category")) for f in dataset.case_files[case_id]]
+            hits.append({"case_id": case_id, "files": files})
+        self.send_json({"data": {"hits": hits, "pagination": pagination}, "warnings": {}})
+
+    def handle_manifest(self, params):
+        dataset = self.server.mock.dataset
+        lines = ["id\tfilename\tmd5\tsize\tstate"]
+        for file_id in params["ids"]:
+            for f in dataset.index["file_id"].get(file_id, []):
+                lines.append("%s\t%s\t%s\t%d\t%s" % (f["file_id"], f["file_name"], f["md5sum"], f["file_size"], f["state"]))
+        self.send_body(200, "\n".join(lines) + "\n", {"Content-Type": "text/tab-separated-values"})
+
+    def handle_data(self, params):
+        dataset = self.server.mock.dataset
+        files = [f for file_id in params["ids"] for f in dataset.index["file_id"].get(file_id, [])]
+        if len(files) == 1:
+            body = dataset.content(files[0])
+            filename = files[0]["file_name"]
+        else:
+            # Fast compression keeps the server from being the bottleneck
+            buf = io.BytesIO()
+            gz = gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=1)
+            tar = tarfile.open(fileobj=gz, mode="w")
+            for f in files:
+                content = dataset.content(f)
+                info = tarfile.TarInfo("%s/%s" % (f["file_id"], f["file_name"]))
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+            tar.close()
+            gz.close()
+            body = buf.getvalue()
+            filename = "gdc_download_%s.tar.gz" % time.strftime("%Y%m%d_%H%M%S")
+
+        headers = {"Content-Disposition": "attachment; filename=%s" % filename}
+        byte_range = self.headers.get("Range")
+        if byte_range:
+            start = int(byte_range.split("=")[1].split("-")[0])
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, len(body) - 1, len(body))
+            return self.send_body(206, body[start:], headers)
+        self.send_body(200, body, headers)
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+class MockGDC(object):
+    """
+    Local stand-in for the GDC API serving a Dataset on the /files, /cases, /manifest and
+    /data endpoints, with a configurable delay per request and maximum page size. Records
+    the time taken by every request, per endpoint.
+    """
+
+    def __init__(self, dataset, port=0, latency=0.0, max_page_size=None):
+        self.dataset = dataset
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.lock = threading.Lock()
+        self.server = ThreadingServer(("127.0.0.1", port), Handler)
+        self.server.mock = self
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.thread = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}
+            self.bytes_sent = 0
+
+    def record(self, endpoint, seconds):
+        with self.lock:
+            self.timings.setdefault(endpoint, []).append(seconds)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a synthetic dataset on a local stand-in for the GDC API.")
+    parser.add_argument("--port", help="Port to listen on. Default: 8765", type=int, default=8765)
+    parser.add_argument("--cases", help="Number of cases. Default: 1000", type=int, default=1000)
+    parser.add_argument("--bams-per-case", help="Number of BAM files per case. Default: 2", type=int, default=2)
+    parser.add_argument("--drugs", help="Number of drug records per clinical XML file, which controls its size. Default: 2", type=int, default=2)
+    parser.add_argument("--latency", help="Seconds to wait before answering each request. Default: 0", type=float, default=0.0)
+    parser.add_argument("--max-page-size", help="Largest page size the server returns, regardless of what is asked for. Default: no limit", type=int)
+    args = parser.parse_args(argv)
+
+    mock = MockGDC(Dataset(args.cases, args.bams_per_case, args.drugs), args.port, args.latency, args.max_page_size)
+    print "Serving %d cases on %s. Set GDC_API_ROOT=%s to use it." % (args.cases, mock.url, mock.url)
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
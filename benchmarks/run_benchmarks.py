@@ -0,0 +1,237 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import bcr_xml
+import mock_gdc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+DEFAULT_BASELINE = os.path.join(BENCHMARK_DIR, "baseline.json")
+DEFAULT_SIZES = "1000,10000,100000"
+DEFAULT_TOLERANCE = 0.25
+OUTPUT_FILE = "output.tsv"
+
+# Differences below these are noise, whatever the tolerance
+MIN_SECONDS_SLACK = 0.5
+MIN_RSS_SLACK_MB = 5.0
+
+def write_lines(path, lines):
+    with open(path, "w") as f:
+        for line in lines:
+            f.write("%s\n" % line)
+    return path
+
+def count_rows(path):
+    """
+    Return the number of rows in a TSV file with a header, or None if it wasn't written
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return max(sum(1 for line in f) - 1, 0)
+
+# Every benchmark writes one row per ID/file to output.tsv in its working directory, so
+# results that are skipped, e.g. by paging past a short page, fail the run
+def file2case_command(dataset, size, workdir):
+    bams = [f["file_name"] for f in dataset.files if f["data_format"] == "BAM"][:size]
+    input_file = write_lines(os.path.join(workdir, "bams.txt"), bams)
+    return ["gdc_file2case.py", "-f", input_file, "-o", os.path.join(workdir, OUTPUT_FILE), "--no-cache"]
+
+def case2clinical_command(dataset, size, workdir):
+    input_file = write_lines(os.path.join(workdir, "cases.txt"), dataset.case_ids[:size])
+    return ["gdc_case2clinical.py", "-f", input_file, "-o", os.path.join(workdir, OUTPUT_FILE), "--no-cache"]
+
+def specs2manifest_command(dataset, size, workdir):
+    return ["gdc_specs2manifest.py", "--data-format", "BAM", "--experimental-strategy", "RNA-Seq", "--primary-site", "Breast",
+            "--num-results", str(size), "--page-size", "1000", "--output-file", os.path.join(workdir, OUTPUT_FILE), "--no-cache"]
+
+def clinical2xml_command(dataset, size, workdir):
+    clinical = [f["file_id"] for f in dataset.files if f["data_category"] == "Clinical"][:size]
+    input_file = write_lines(os.path.join(workdir, "clinical.txt"), clinical)
+    return ["gdc_clinical2xml.py", "-f", input_file, "-o", workdir, "-s", "500", "-t", os.path.join(workdir, OUTPUT_FILE)]
+
+def xml_parser_command(dataset, size, workdir):
+    xml_dir = os.path.join(workdir, "xml")
+    bcr_xml.write_xml_files(xml_dir, size, dataset.drugs)
+    return ["gdc_xml_parser.py", "-i", xml_dir, "-o", os.path.join(workdir, OUTPUT_FILE)]
+
+def pipeline_command(dataset, size, workdir):
+    # Every case has the same number of BAMs, so searching for that many per case finds size cases
+    bams_per_case = len([f for f in dataset.case_files[dataset.case_ids[0]] if f["data_format"] == "BAM"])
+    return ["gdc_pipeline.py", "--data-format", "BAM", "--experimental-strategy", "RNA-Seq", "--primary-site", "Breast",
+            "--num-results", str(size * bams_per_case), "--page-size", "1000", "-o", os.path.join(workdir, OUTPUT_FILE), "--no-cache"]
+
+# Name, function returning the command line for a number of IDs/files
+BENCHMARKS = [
+    ("file2case", file2case_command),
+    ("case2clinical", case2clinical_command),
+    ("specs2manifest", specs2manifest_command),
+    ("clinical2xml", clinical2xml_command),
+    ("xml_parser", xml_parser_command),
+    ("pipeline", pipeline_command),
+]
+
+def percentile(values, p):
+    """
+    Return the p-th percentile of values, by nearest rank
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(round(p / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+class Spawner(object):
+    """
+    Runs tools through spawner.py, which has to be started before the dataset is generated
+    """
+
+    def __init__(self):
+        self.process = subprocess.Popen([sys.executable, os.path.join(BENCHMARK_DIR, "spawner.py")],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def run(self, args, cwd, env, log):
+        """
+        Run a command and return a dict with its seconds, peak_rss_mb and status
+        """
+        self.process.stdin.write(json.dumps({"args": args, "cwd": cwd, "env": env, "log": log}) + "\n")
+        self.process.stdin.flush()
+        return json.loads(self.process.stdout.readline())
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+def run_tool(spawner, command, mock, workdir):
+    """
+    Run a tool against the mock server. Returns (seconds, peak RSS in MB, exit status).
+    """
+    env = dict(os.environ)
+    env["GDC_API_ROOT"] = mock.url
+    env["HOME"] = workdir  # Keep caches and mapping stores out of the real home directory
+    args = [sys.executable, os.path.join(REPO_DIR, command[0])] + command[1:]
+    result = spawner.run(args, workdir, env, os.path.join(workdir, "output.log"))
+    return result["seconds"], result["peak_rss_mb"], result["status"]
+
+def run_benchmark(spawner, name, make_command, dataset, size, mock):
+    workdir = tempfile.mkdtemp(prefix="gdc-bench-%s-" % name)
+    try:
+        command = make_command(dataset, size, workdir)
+        mock.reset()
+        seconds, peak_rss_mb, status = run_tool(spawner, command, mock, workdir)
+        if status != 0:
+            with open(os.path.join(workdir, "output.log")) as f:
+                print f.read()[-2000:]
+            raise RuntimeError("%s exited with status %d" % (command[0], status))
+        rows = count_rows(os.path.join(workdir, OUTPUT_FILE))
+        if rows != size:
+            raise RuntimeError("%s wrote %s rows, expected %d" % (command[0], rows, size))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies = [t for timings in mock.timings.values() for t in timings]
+    result = {
+        "seconds": round(seconds, 3),
+        "items_per_second": round(size / seconds, 1),
+        "requests": len(latencies),
+        "bytes_sent": mock.bytes_sent,
+        "peak_rss_mb": round(peak_rss_mb, 1),
+    }
+    for p in [50, 90, 99]:
+        value = percentile(latencies, p)
+        result["latency_p%d_ms" % p] = round(value * 1000, 2) if value is not None else None
+    return result
+
+def compare(results, baseline, tolerance):
+    """
+    Return a list of regressions of results against baseline, as readable strings
+    """
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        if result["seconds"] > base["seconds"] * (1 + tolerance) + MIN_SECONDS_SLACK:
+            regressions.append("%s: %.2f s, baseline %.2f s" % (key, result["seconds"], base["seconds"]))
+        if result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance) + MIN_RSS_SLACK_MB:
+            regressions.append("%s: peak RSS %.1f MB, baseline %.1f MB" % (key, result["peak_rss_mb"], base["peak_rss_mb"]))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the gdc_* tools against a local stand-in for the GDC API.")
+    parser.add_argument("--sizes", help="Comma-separated numbers of IDs/files to benchmark with. Default: %s" % DEFAULT_SIZES, default=DEFAULT_SIZES)
+    parser.add_argument("--tools", help="Comma-separated benchmarks to run. Default: all (%s)" % ", ".join(name for name, _ in BENCHMARKS))
+    parser.add_argument("--latency", help="Seconds the mock server waits before answering each request. Default: 0", type=float, default=0.0)
+    parser.add_argument("--max-page-size", help="Largest page size the mock server returns. Default: no limit", type=int)
+    parser.add_argument("--drugs", help="Number of drug records per clinical XML file, which controls its size. Default: 2", type=int, default=2)
+    parser.add_argument("--baseline", help="Baseline to compare with. Default: %s" % DEFAULT_BASELINE, default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", help="Allowed slowdown or memory growth relative to the baseline before failing. Default: %.2f" % DEFAULT_TOLERANCE, type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--update-baseline", help="Write the results to the baseline file instead of comparing.", action="store_true", default=False)
+    parser.add_argument("-o", "--output-file", help="Write the results to this JSON file.")
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    benchmarks = BENCHMARKS
+    if args.tools:
+        names = args.tools.split(",")
+        benchmarks = [(name, make_command) for name, make_command in BENCHMARKS if name in names]
+
+    # Start the tools from a process that doesn't hold the dataset
+    spawner = Spawner()
+
+    # One dataset, big enough for the largest run
+    print "Generating dataset with %d cases" % max(sizes)
+    dataset = mock_gdc.Dataset(max(sizes), drugs=args.drugs)
+    mock = mock_gdc.MockGDC(dataset, latency=args.latency, max_page_size=args.max_page_size).start()
+
+    results = {}
+    print "\n{0:28}{1:>10}{2:>12}{3:>10}{4:>10}{5:>10}{6:>10}".format("BENCHMARK", "SECONDS", "ITEMS/S", "REQUESTS", "P50 MS", "P99 MS", "RSS MB")
+    try:
+        for size in sizes:
+            for name, make_command in benchmarks:
+                key = "%s@%d" % (name, size)
+                result = run_benchmark(spawner, name, make_command, dataset, size, mock)
+                results[key] = result
+                print "{0:28}{1:>10.2f}{2:>12.1f}{3:>10}{4:>10}{5:>10}{6:>10.1f}".format(
+                    key, result["seconds"], result["items_per_second"], result["requests"],
+                    result["latency_p50_ms"], result["latency_p99_ms"], result["peak_rss_mb"])
+    finally:
+        mock.stop()
+        spawner.close()
+
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print "\nWrote results to %s" % args.output_file
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print "\nUpdated baseline %s" % args.baseline
+        return
+
+    if not os.path.exists(args.baseline):
+        print "\nNo baseline at %s, run with --update-baseline to create one" % args.baseline
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print "\nERROR: %d regression(s) against %s:" % (len(regressions), args.baseline)
+        for regression in regressions:
+            print regression
+        sys.exit(1)
+    print "\nNo regressions against %s" % args.baseline
+
+if __name__ == "__main__":
+    main()
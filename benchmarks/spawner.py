@@ -0,0 +1,28 @@
+import os
+import sys
+import json
+import time
+import subprocess
+
+# run_benchmarks.py starts this process before it generates the benchmark dataset and
+# has it start the tools. A child forked from the big benchmark process would count that
+# process' memory towards its own peak RSS until it execs the tool.
+
+def main():
+    """
+    Read one JSON job per line from stdin with args, cwd, env and log, run it, and write
+    its wall time in seconds, peak RSS in MB and exit status to stdout as a JSON line
+    """
+    for line in iter(sys.stdin.readline, ""):
+        job = json.loads(line)
+        with open(job["log"], "w") as log:
+            start = time.time()
+            p = subprocess.Popen(job["args"], stdout=log, stderr=subprocess.STDOUT, cwd=job["cwd"], env=job["env"])
+            _, status, rusage = os.wait4(p.pid, 0)
+            seconds = time.time() - start
+        # ru_maxrss is in kilobytes on Linux
+        sys.stdout.write(json.dumps({"seconds": seconds, "peak_rss_mb": rusage.ru_maxrss / 1024.0, "status": status}) + "\n")
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import zlib
+import hashlib
+import sqlite3
+import threading
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".gdc-tools")
+DEFAULT_CACHE_FILE = os.path.join(CACHE_DIR, "cache.sqlite")
+DEFAULT_MEMO_FILE = os.path.join(CACHE_DIR, "mappings.sqlite")
+DEFAULT_VOCABULARY_FILE = os.path.join(CACHE_DIR, "vocabulary.json")
+DEFAULT_TTL_HOURS = 24
+DEFAULT_VOCABULARY_TTL_HOURS = 24 * 7
+DEFAULT_MAX_SIZE_MB = 512
+
+class ResponseCache(object):
+    """
+    On-disk SQLite cache of API query responses, keyed on endpoint and canonicalized query
+    parameters. Entries expire after ttl seconds, and the least recently used entries are
+    evicted when the cache grows beyond max_size bytes. Safe to share between threads.
+    """
+
+    def __init__(self, cache_filepath=DEFAULT_CACHE_FILE, ttl=DEFAULT_TTL_HOURS * 3600, max_size=DEFAULT_MAX_SIZE_MB * 1024 * 1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        # Create directory if it doesn't exist
+        cache_dir = os.path.dirname(os.path.abspath(cache_filepath))
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.conn = sqlite3.connect(cache_filepath, timeout=30, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, created REAL, accessed REAL, size INTEGER, body BLOB)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.conn.commit()
+
+    @staticmethod
+    def key(endpoint, params):
+        """
+        Return the cache key for a query. Filters are canonicalized (whether given as a dict
+        or a JSON string) and the order of fields doesn't matter.
+        """
+        canonical = dict(params)
+        if isinstance(canonical.get("filters"), basestring):
+            canonical["filters"] = json.loads(canonical["filters"])
+        if isinstance(canonical.get("fields"), basestring):
+            canonical["fields"] = ",".join(sorted(canonical["fields"].split(",")))
+        canonical.pop("pretty", None)
+        return hashlib.sha1(json.dumps([endpoint, canonical], sort_keys=True)).hexdigest()
+
+    def get(self, key):
+        """
+        Return the cached response body for key, or None if it's missing or expired
+        """
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT created, body FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[0] > self.ttl:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.conn.commit()
+                return None
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+        return zlib.decompress(row[1])
+
+    def put(self, key, body):
+        """
+        Store a response body, evicting least recently used entries if the cache is full
+        """
+        now = time.time()
+        data = zlib.compress(body)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, created, accessed, size, body) VALUES (?, ?, ?, ?, ?)",
+                              (key, now, now, len(data), sqlite3.Binary(data)))
+            self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        """
+        Delete expired entries, then least recently used entries until the cache fits in max_size
+        """
+        self.conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+        total_size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        evicted = []
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if total_size <= self.max_size:
+                break
+            evicted.append((key,))
+            total_size -= size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def close(self):
+        self.conn.close()
+
+class MappingStore(object):
+    """
+    Persistent SQLite store of resolved ID mappings, e.g. file name to case UUID. Mappings
+    don't expire, so IDs that have been resolved once never have to be sent to the API again.
+    A key can map to more than one value.
+    """
+
+    # Stay below SQLite's limit on the number of variables in a statement
+    CHUNK_SIZE = 500
+
+    def __init__(self, memo_filepath=DEFAULT_MEMO_FILE):
+        # Create directory if it doesn't exist
+        memo_dir = os.path.dirname(os.path.abspath(memo_filepath))
+        if not os.path.exists(memo_dir):
+            os.makedirs(memo_dir)
+
+        self.conn = sqlite3.connect(memo_filepath, timeout=30)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS mappings (kind TEXT, key TEXT, value TEXT, PRIMARY KEY (kind, key, value))")
+        self.conn.commit()
+
+    def lookup(self, kind, keys):
+        """
+        Return a dictionary with key/value key/list of values for the keys that are known
+        """
+        known = {}
+        keys = list(keys)
+        for i in range(0, len(keys), self.CHUNK_SIZE):
+            chunk = keys[i:i + self.CHUNK_SIZE]
+            query = "SELECT key, value FROM mappings WHERE kind = ? AND key IN (%s)" % ",".join("?" * len(chunk))
+            for key, value in self.conn.execute(query, [kind] + chunk):
+                known.setdefault(key, []).append(value)
+        return known
+
+    def store(self, kind, pairs):
+        """
+        Store (key, value) pairs
+        """
+        self.conn.executemany("INSERT OR IGNORE INTO mappings (kind, key, value) VALUES (?, ?, ?)",
+                              [(kind, key, value) for key, value in pairs])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+class VocabularyCache(object):
+    """
+    JSON file with the valid values of search fields, e.g. every primary site, as fetched
+    from the API's facets. The values are considered fresh for ttl seconds.
+    """
+
+    def __init__(self, vocabulary_filepath=DEFAULT_VOCABULARY_FILE, ttl=DEFAULT_VOCABULARY_TTL_HOURS * 3600):
+        self.vocabulary_filepath = vocabulary_filepath
+        self.ttl = ttl
+
+    def load(self):
+        """
+        Return a tuple of (dictionary with key/value field/list of values, True if fresh),
+        or (None, False) if there is no readable vocabulary
+        """
+        try:
+            with open(self.vocabulary_filepath, "r") as f:
+                cached = json.load(f)
+            return cached["values"], time.time() - cached["fetched"] < self.ttl
+        except (IOError, ValueError, KeyError):
+            return None, False
+
+    def save(self, values):
+        # Create directory if it doesn't exist
+        vocabulary_dir = os.path.dirname(os.path.abspath(self.vocabulary_filepath))
+        if not os.path.exists(vocabulary_dir):
+            os.makedirs(vocabulary_dir)
+
+        # Write to a temporary file first, so concurrent runs never read half a file
+        tmp_filepath = "%s.%d.tmp" % (self.vocabulary_filepath, os.getpid())
+        with open(tmp_filepath, "w") as f:
+            json.dump({"fetched": time.time(), "values": values}, f, indent=2, sort_keys=True)
+        os.rename(tmp_filepath, self.vocabulary_filepath)
+
+def add_cache_arguments(parser):
+    """
+    Add arguments for the response cache to an argparse parser
+    """
+    parser.add_argument("--no-cache", help="Don't read or write the local response cache, ID mapping store or vocabulary.", action="store_true", default=False, required=False)
+    parser.add_argument("--refresh", help="Query the API even for cached responses, known ID mappings and valid search values, and update the cache with the new responses.", action="store_true", default=False, required=False)
+    parser.add_argument("--cache-file", help="Path to the response cache. Default: %s" % DEFAULT_CACHE_FILE, default=DEFAULT_CACHE_FILE, required=False)
+    parser.add_argument("--cache-ttl", help="Hours before a cached response expires. Default: %d" % DEFAULT_TTL_HOURS, type=float, default=DEFAULT_TTL_HOURS, required=False)
+    parser.add_argument("--cache-max-size", help="Maximum size of the response cache in MB. Least recently used responses are evicted first. Default: %d" % DEFAULT_MAX_SIZE_MB, type=float, default=DEFAULT_MAX_SIZE_MB, required=False)
+
+def cache_from_args(args):
+    """
+    Create a ResponseCache from arguments added with add_cache_arguments, or None if caching is disabled
+    """
+    if args.no_cache:
+        return None
+    return ResponseCache(args.cache_file, ttl=args.cache_ttl * 3600, max_size=int(args.cache_max_size * 1024 * 1024))
+
+def add_memo_arguments(parser):
+    """
+    Add arguments for the mapping store to an argparse parser. --no-cache and --refresh
+    from add_cache_arguments apply to the mapping store as well.
+    """
+    parser.add_argument("--memo-file", help="Path to the store of resolved ID mappings. IDs found there are not sent to the API. Default: %s" % DEFAULT_MEMO_FILE, default=DEFAULT_MEMO_FILE, required=False)
+
+def memo_from_args(args):
+    """
+    Create a MappingStore from arguments added with add_memo_arguments, or None if caching is disabled
+    """
+    if args.no_cache:
+        return None
+    return MappingStore(args.memo_file)
+
+def add_vocabulary_arguments(parser):
+    """
+    Add arguments for the vocabulary cache to an argparse parser. --no-cache and --refresh
+    from add_cache_arguments apply to the vocabulary as well.
+    """
+    parser.add_argument("--vocabulary-file", help="Path to the cached list of valid search values. Default: %s" % DEFAULT_VOCABULARY_FILE, default=DEFAULT_VOCABULARY_FILE, required=False)
+    parser.add_argument("--vocabulary-ttl", help="Hours before the valid search values are fetched again. Default: %d" % DEFAULT_VOCABULARY_TTL_HOURS, type=float, default=DEFAULT_VOCABULARY_TTL_HOURS, required=False)
+
+def vocabulary_from_args(args):
+    """
+    Create a VocabularyCache from arguments added with add_vocabulary_arguments, or None if caching is disabled
+    """
+    if args.no_cache:
+        return None
+    return VocabularyCache(args.vocabulary_file, ttl=args.vocabulary_ttl * 3600)
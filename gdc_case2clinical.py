@@ -3,69 +3,116 @@ import json
 import sys
 import argparse
 import os
+import gdc_client
+import gdc_cache
+import gdc_engine
+import gdc_metrics
+from gdc_client import FILES_ENDPOINT
 
-# TODO: Handle request response status codes
 # TODO: Print response warnings, if any
 
-CASES_ENDPOINT = "https://gdc-api.nci.nih.gov/cases"
 
 class File2Case(object):
 
     def find_files(self):
         """
-        Query API for case UUID and return file ID of clinical data files
+        Query API for case UUIDs and yield (case UUID, file ID) pairs for clinical data files.
+        Only the per-patient BCR XML clinical files are requested from the files endpoint. Cases found in the mapping
+        store are answered from there, and the rest are queried in concurrent batches whose
+        results are yielded as each batch completes.
         """
+        # Mappings stored before BCR Biotab files were left out can include them, so they have their own kind
+        memo_kind = "case_id:bcr_xml_file_id"
+        known = {}
+        if self.memo is not None and not self.refresh:
+            known = self.memo.lookup(memo_kind, set(self.case_uuids))
+            print "Found %d of %d case(s) in the mapping store" % (len(known), len(set(self.case_uuids)))
+            gdc_metrics.count("memo_hits", len(known))
+
+        # Yield known cases first, and collect the ones that have to be queried
+        pending = []
+        seen = set()
+        for case_id in self.case_uuids:
+            if case_id in seen:
+                continue
+            seen.add(case_id)
+            if case_id in known:
+                for file_id in known[case_id]:
+                    yield case_id, file_id
+            else:
+                pending.append(case_id)
+
+        # Query the remaining cases in batches, concurrently. Batches are merged as they complete.
+        batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+        for batch, resolved, error in self.engine.map_unordered(self.query_batch, batches):
+            if error is not None:
+                raise error
+
+            # Only record a batch once all of its pages are in, so a case is never stored with some of its files missing
+            if self.memo is not None and resolved:
+                self.memo.store(memo_kind, resolved)
 
-        # First, create a filter saying we're providing file names
+            for case_id, file_id in resolved:
+                yield case_id, file_id
+
+    def query_batch(self, batch):
+        """
+        Query API for the clinical files of a single batch of case UUIDs, and return a list
+        of (case UUID, file ID) pairs. Only the per-patient BCR XML files are wanted: the BCR
+        Biotab TXT files are project-wide and list every case in the project, so they would
+        make responses grow with the size of the project.
+        """
+        # First, create a filter saying we're looking for clinical files belonging to the provided cases
         filters = {
-            "op":"=",
-            "content": {
-                "field": self.query_field,
-                "value": self.case_uuids
-            }
+            "op":"and",
+            "content": [
+                {"op":"=","content":{"field": "data_category", "value": "Clinical"}},
+                {"op":"=","content":{"field": "data_format", "value": "BCR XML"}},
+                {"op":"in","content":{"field": self.query_field, "value": batch}},
+            ]
         }
 
-        # Setup the rest of the parameters, saying we're looking for matching case UUIDs
+        # Setup the rest of the parameters, saying we're looking for file IDs and their cases
         params = {
-            "filters": json.dumps(filters),
+            "filters": filters,
             "fields": self.result_field,
-            "format": "json",
-            "pretty": "true"
+            "format": "json"
         }
 
-        # Perform HTTP GET request
-        response = requests.get(CASES_ENDPOINT, params=params)
-
-        # Parse API response
-        data = response.json()["data"]
-
-        # Debug: Print entire response
-        # print json.dumps(response.json(), indent=2)
-
-        # Check for matching results
-        if len(data["hits"]) == 0:
-            return
+        # A case can have more than one clinical file, so keep every pair
+        case_set = set(batch)
+        pairs = []
+        for result in self.engine.query_all(FILES_ENDPOINT, params, self.page_size):
+            for case in result["cases"]:
+                if case["case_id"] in case_set:
+                    pairs.append((case["case_id"], result["file_id"]))
+        return pairs
 
-        # Check for clinical data in the results
-        for result in data["hits"]:
-            case_id = result["case_id"]
-
-            # Find name of clinical file
-            if len(result["files"]) > 0:
-                for f in result["files"]:
-                    if f["data_category"].lower() == "clinical":
-                        # Store file ID for clinical data to dictionary
-                        self.results[case_id] = f["file_id"]
-
-    def handle_arguments(self):
+    def handle_arguments(self, argv=None):
         self.parser = argparse.ArgumentParser()
         self.parser.add_argument("-i", "--input", help="Case UUIDs for which to find clinical data. Can be a single case UUID or a comma-serparated list of case UUIDs", required=False)
         self.parser.add_argument("-f", "--from-file", help="Path to a file containing case UUIDs to look up. One case UUID per line.", required=False)
         self.parser.add_argument("-o", "--output-file", help="Path to output file. Missing directories will be created. Default: Current directory/case2clinical_results.tsv", default=os.path.join(os.getcwd(), "case2clinical_results.tsv"), required=False)
-        args = self.parser.parse_args()
+        self.parser.add_argument("-b", "--batch-size", help="Number of case UUIDs to look up per API request. Default: 500", type=int, default=500, required=False)
+        self.parser.add_argument("--page-size", help="Number of clinical files to fetch per API request. Default: 500", type=int, default=500, required=False)
+        gdc_client.add_client_arguments(self.parser)
+        gdc_cache.add_cache_arguments(self.parser)
+        gdc_cache.add_memo_arguments(self.parser)
+        gdc_engine.add_engine_arguments(self.parser)
+        gdc_metrics.add_metrics_arguments(self.parser)
+        args = self.parser.parse_args(argv)
+        gdc_metrics.start_from_args(args)
+        self.client = gdc_client.client_from_args(args)
+        self.engine = gdc_engine.engine_from_args(args, self.client)
+        self.memo = gdc_cache.memo_from_args(args)
+        self.refresh = args.refresh
         self.input_arg = args.input
         self.from_file = args.from_file
         self.output_file = args.output_file
+        self.batch_size = args.batch_size
+        self.page_size = args.page_size
+        self.workers = args.workers
+        self.retries = args.retries
 
     def validate_arguments(self):
         # Check which input options are set
@@ -116,47 +163,79 @@ class File2Case(object):
                 if not os.path.isdir(os.path.dirname(self.output_file)):
                     raise
 
-    def __init__(self):
+    def __init__(self, case_uuids=None, output_file=None, batch_size=500, page_size=500, workers=gdc_engine.DEFAULT_WORKERS, retries=gdc_engine.DEFAULT_RETRIES, client=None, engine=None, memo=None, refresh=False):
         self.parser = None
         self.input_arg = None
-        self.case_uuids = None
+        self.case_uuids = case_uuids
         self.from_file = None
-        self.output_file = None
-        self.query_field = "case_id"  # What we're providing (case UUID)
-        self.result_field = "case_id,files.data_category,files.file_id,files.file_name"  # What we're looking for
-        self.results = {}  # Dict of results with key/value case_id/clinical file id
-
-        # Handle args
-        self.handle_arguments()
-        self.validate_arguments()
-
-        # Feedback to user: Tell them which files we think we're meant to use
-        print "Provided case UUIDs:"
-        for c in self.case_uuids:
-            print "Case --> %s" % c
-
-        # Query API
-        self.find_files()
-
-        # Print results to stdout
-        if len(self.results) == 0:
-            print "No results found"
-            sys.exit()
-
-        print "\n{0:60}{1:60}".format("CASE UUID", "CLINICAL FILE ID")
-        for case_id, result_file in self.results.items():
-            print "{0:60}{1:60}".format(case_id, result_file)
-
-        # Save it to a TSV file
-        with open(self.output_file, "w") as out_file:
+        self.output_file = output_file
+        self.batch_size = batch_size
+        self.page_size = page_size
+        self.workers = workers
+        self.retries = retries
+        self.client = client
+        self.engine = engine
+        self.memo = memo
+        self.refresh = refresh
+        self.query_field = "cases.case_id"  # What we're providing (case UUID)
+        self.result_field = "file_id,cases.case_id"  # What we're looking for
+        self.num_results = 0
+
+    def run(self):
+        """
+        Look up the clinical files of case_uuids. Returns a list of (case UUID, file ID) tuples.
+        Use find_files to get them one at a time as they arrive instead. Without an engine,
+        one is created for the run and closed when it is done.
+        """
+        if self.client is None:
+            self.client = gdc_client.GDCClient()
+        own_engine = self.engine is None
+        if own_engine:
+            self.engine = gdc_engine.QueryEngine(self.client, workers=self.workers, retries=self.retries)
+        try:
+            return list(self.find_files())
+        finally:
+            if own_engine:
+                self.engine.close()
+                self.engine = None
+
+@gdc_metrics.instrumented("gdc_case2clinical")
+def main(argv=None):
+    case2clinical = File2Case()
+
+    # Handle args
+    case2clinical.handle_arguments(argv)
+    case2clinical.validate_arguments()
+
+    # Feedback to user: Tell them which files we think we're meant to use
+    print "Provided case UUIDs:"
+    for c in case2clinical.case_uuids:
+        print "Case --> %s" % c
+
+    # Query API and stream results to stdout and a TSV file as they arrive
+    print "\n{0:60}{1:60}".format("CASE UUID", "CLINICAL FILE ID")
+    try:
+        with gdc_metrics.stage("find_files") as stage, open(case2clinical.output_file, "w") as out_file:
+            stage.add(len(set(case2clinical.case_uuids)))
             out_file.write("%s\t%s\n" % ("CASE UUID", "CLINICAL FILE ID"))
-            for case_id, result_file in self.results.items():
+            for case_id, result_file in case2clinical.find_files():
+                print "{0:60}{1:60}".format(case_id, result_file)
                 out_file.write("%s\t%s\n" % (case_id, result_file))
+                case2clinical.num_results += 1
+    except requests.exceptions.RequestException as e:
+        print "ERROR: Something went wrong. %s" % e
+        sys.exit()
+    finally:
+        case2clinical.engine.close()
+
+    if case2clinical.num_results == 0:
+        print "No results found"
+        sys.exit()
 
-        print "\nWrote results to %s" % self.output_file
+    print "\nWrote results to %s" % case2clinical.output_file
 
 if __name__ == "__main__":
-    file2case = File2Case()
+    main()
 
 
 
@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import gdc_cache
+import gdc_metrics
+
+# The API location can be overridden, e.g. to point at a local stand-in server
+API_ROOT = os.environ.get("GDC_API_ROOT", "https://gdc-api.nci.nih.gov")
+CASES_ENDPOINT = API_ROOT + "/cases"
+DATA_ENDPOINT = API_ROOT + "/data"
+FILES_ENDPOINT = API_ROOT + "/files"
+MANIFEST_ENDPOINT = API_ROOT + "/manifest"
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 60
+DEFAULT_HTTP_RETRIES = 5
+DEFAULT_BACKOFF_FACTOR = 0.5
+
+# Rate limiting and server errors are worth retrying
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+class GDCClient(object):
+    """
+    HTTP client for the GDC API, shared by the gdc_* tools. Requests go through a single
+    keep-alive session with a connection pool, so repeated requests reuse connections
+    instead of paying for a new TLS handshake each time. Requests that fail with a
+    connection error, 429 or 5xx are retried with exponential backoff. If a response
+    cache is given, query responses are served from it when possible. Every request is
+    recorded in gdc_metrics.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_HTTP_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR, cache=None, refresh=False):
+        self.timeout = timeout
+        self.cache = cache
+        self.refresh = refresh
+
+        # Retry POSTs too, the API uses them for queries. Older urllib3 calls allowed_methods method_whitelist.
+        retry_args = {
+            "total": retries,
+            "backoff_factor": backoff_factor,
+            "status_forcelist": RETRY_STATUS_CODES,
+            "raise_on_status": False,
+            "respect_retry_after_header": True,
+        }
+        try:
+            retry = Retry(allowed_methods=False, **retry_args)
+        except TypeError:
+            retry = Retry(method_whitelist=False, **retry_args)
+
+        # Block instead of opening extra connections when all pooled connections are in use
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry, pool_block=True)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate"})
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request and record its time, size and retries. Streamed responses are timed
+        until their headers arrive, and their size is taken from the content-length header.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.time()
+        try:
+            r = self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            gdc_metrics.add_request(method, url, None, time.time() - start)
+            raise
+        if kwargs.get("stream"):
+            num_bytes = int(r.headers.get("content-length") or 0)
+        else:
+            num_bytes = len(r.content)
+        # urllib3 keeps the retries it made on the raw response
+        retry = getattr(r.raw, "retries", None)
+        retries = len(retry.history) if retry is not None else 0
+        gdc_metrics.add_request(method, url, r.status_code, time.time() - start, num_bytes, retries)
+        return r
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def post_json(self, url, body, headers=None, **kwargs):
+        """
+        POST a JSON body, e.g. a query with a large filter that wouldn't fit in a URL
+        """
+        all_headers = {"content-type": "application/json"}
+        if headers:
+            all_headers.update(headers)
+        return self.post(url, data=json.dumps(body), headers=all_headers, **kwargs)
+
+    def query(self, url, params):
+        """
+        POST a query to a search endpoint and return the decoded JSON response. Responses are
+        read from the cache unless refresh is set, and stored in the cache on success.
+        Raises requests.exceptions.HTTPError with the server's message on a non-200 response.
+        """
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(url, params)
+            if not self.refresh:
+                body = self.cache.get(key)
+                if body is not None:
+                    gdc_metrics.count("cache_hits")
+                    return json.loads(body)
+            gdc_metrics.count("cache_misses")
+
+        r = self.post_json(url, params)
+        if r.status_code != 200:
+            raise requests.exceptions.HTTPError("HTTP status code %s. Server says:\n%s" % (r.status_code, r.text), response=r)
+        if key is not None:
+            self.cache.put(key, r.content)
+        return r.json()
+
+def add_client_arguments(parser):
+    """
+    Add arguments for the HTTP client to an argparse parser
+    """
+    parser.add_argument("--pool-size", help="Number of pooled HTTP connections to the API. Default: %d" % DEFAULT_POOL_SIZE, type=int, default=DEFAULT_POOL_SIZE, required=False)
+    parser.add_argument("--timeout", help="Seconds to wait for the API before giving up on a request. Default: %d" % DEFAULT_TIMEOUT, type=float, default=DEFAULT_TIMEOUT, required=False)
+    parser.add_argument("--http-retries", help="Number of times to retry a request that fails with a connection error, 429 or 5xx. Default: %d" % DEFAULT_HTTP_RETRIES, type=int, default=DEFAULT_HTTP_RETRIES, required=False)
+
+def client_from_args(args):
+    """
+    Create a GDCClient from arguments added with add_client_arguments, with a response
+    cache if arguments were also added with gdc_cache.add_cache_arguments
+    """
+    cache = None
+    refresh = False
+    if hasattr(args, "no_cache"):
+        cache = gdc_cache.cache_from_args(args)
+        refresh = args.refresh
+    return GDCClient(pool_size=args.pool_size, timeout=args.timeout, retries=args.http_retries, cache=cache, refresh=refresh)
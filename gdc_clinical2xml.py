@@ -3,57 +3,479 @@ import json
 import sys
 import argparse
 import os
+import re
+import time
+import hashlib
+import tarfile
+import zlib
+from multiprocessing.pool import ThreadPool
+from requests.packages.urllib3.exceptions import ProtocolError
+import gdc_client
+import gdc_metrics
+import gdc_xml_parser
+from gdc_client import DATA_ENDPOINT
 
 # TODO: Print response warnings, if any
 
-CASES_ENDPOINT = "https://gdc-api.nci.nih.gov/cases"
-DATA_ENDPOINT = "https://gdc-api.nci.nih.gov/data"
+LEDGER_FILENAME = "clinical2xml_ledger.tsv"
+
+# Downloads are already compressed, and byte ranges have to refer to the file itself
+IDENTITY_ENCODING = {"Accept-Encoding": "identity"}
+
+def format_bytes(num_bytes):
+    """
+    Format a number of bytes as a human readable string, e.g. 1.5 MB
+    """
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(num_bytes) < 1024.0:
+            return "%.1f %s" % (num_bytes, unit)
+        num_bytes /= 1024.0
+    return "%.1f TB" % num_bytes
+
+def content_range_start(content_range):
+    """
+    Return the first byte of a Content-Range header like "bytes 100-199/200", or None
+    """
+    match = re.match(r"bytes (\d+)-\d+/", content_range or "")
+    return int(match.group(1)) if match else None
+
+def content_range_total(content_range):
+    """
+    Return the total size in a Content-Range header like "bytes 100-199/200", or None if
+    it is unknown ("*")
+    """
+    match = re.match(r"bytes \d+-\d+/(\d+)", content_range or "")
+    return int(match.group(1)) if match else None
+
+def response_validator(r):
+    """
+    Return the validator to send in If-Range to resume a response: its ETag if it is a
+    strong one, otherwise its Last-Modified date. Returns None if it has neither.
+    """
+    etag = r.headers.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return r.headers.get("last-modified")
+
+def is_complete_download(filepath, ext):
+    """
+    Check that a download of unknown size is complete, by reading a tar.gz archive to
+    the end, where gzip checks its length and CRC, or parsing an XML file
+    """
+    try:
+        if ext == ".tar.gz":
+            with tarfile.open(filepath, "r:gz") as tar:
+                for member in tar:
+                    if member.isfile():
+                        tar.extractfile(member).read()
+        elif ext == ".xml":
+            gdc_xml_parser.extract_tags(filepath, set())
+        return True
+    except (tarfile.TarError, IOError, EOFError, zlib.error, gdc_xml_parser.ET.ParseError):
+        return False
+
+# Errors of a failed download
+DOWNLOAD_ERRORS = (requests.exceptions.RequestException, ProtocolError, tarfile.TarError, IOError, EOFError, zlib.error)
+
+# Errors of a download that broke off while it streamed in, which are worth retrying
+STREAM_ERRORS = (requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError, ProtocolError, tarfile.TarError, IOError, EOFError, zlib.error)
+
+def is_stream_error(e):
+    """
+    Return True if e is an error of a download that broke off while it streamed in. Other
+    request errors aren't retried: the client has already retried connection errors, 429
+    and 5xx, and other HTTP errors, like a 4xx, fail right away.
+    """
+    if isinstance(e, requests.exceptions.RequestException):
+        # Request errors are IOErrors too
+        return isinstance(e, (requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError))
+    return isinstance(e, STREAM_ERRORS)
+
+def download_records(client, file_ids, done=None):
+    """
+    Download file IDs and yield the patient record of each XML file in the response as it
+    streams in. A tar.gz archive is read in streaming mode, so nothing touches the
+    filesystem and records reach the caller while the archive is still downloading. Files
+    that can't be parsed are skipped. If done is a set, the names of the XML files handled
+    are added to it, and files already in it are skipped, so a failed download can be
+    retried without yielding a record twice. Raises requests.exceptions.HTTPError with the
+    server's message on a non-200 response.
+    """
+    if done is None:
+        done = set()
+    with gdc_metrics.stage("download_and_parse") as stage:
+        r = client.post_json(DATA_ENDPOINT, {"ids": file_ids}, headers=IDENTITY_ENCODING, stream=True)
+        if r.status_code != 200:
+            raise requests.exceptions.HTTPError("HTTP status code %s. Server says:\n%s" % (r.status_code, r.text), response=r)
+
+        fname = re.findall("filename=(.+)", r.headers["content-disposition"])[0]
+        r.raw.decode_content = True
+        if fname.endswith(".tar.gz"):
+            tar = tarfile.open(fileobj=r.raw, mode="r|gz")
+            members = ((member.name, tar.extractfile(member)) for member in tar if member.isfile() and member.name.endswith(".xml"))
+        else:
+            # A single file is sent as plain XML
+            tar = None
+            members = [(fname, r.raw)]
+        try:
+            for name, xml_file in members:
+                if name in done:
+                    continue
+                _, record, error = gdc_xml_parser.parse_file(xml_file)
+                done.add(name)
+                stage.add()
+                if error is not None:
+                    print "ERROR: Could not parse %s (%s). Skipping." % (name, error)
+                    continue
+                yield record
+        finally:
+            if tar is not None:
+                tar.close()
+            r.close()
+
+def iter_download_records(client, file_ids, retries):
+    """
+    Yield the patient records of file IDs with download_records, retrying a download that
+    broke off while it streamed in with exponential backoff. Files parsed before a download
+    failed are skipped when it is retried. Raises the last error if the download still
+    fails after retries, and other errors, like the HTTPError of a 4xx, right away.
+    """
+    done = set()
+    attempt = 0
+    while True:
+        try:
+            for record in download_records(client, file_ids, done):
+                yield record
+            return
+        except DOWNLOAD_ERRORS as e:
+            attempt += 1
+            if not is_stream_error(e) or attempt > retries:
+                raise
+            gdc_metrics.count("download_retries")
+            time.sleep(2 ** attempt)
 
 class File2Case(object):
 
+    def report_progress(self, num_bytes, total_bytes, elapsed):
+        """
+        Print download progress with throughput, and ETA if the total size is known
+        """
+        rate = num_bytes / elapsed if elapsed > 0 else 0
+        message = "Downloaded %s" % format_bytes(num_bytes)
+        if total_bytes:
+            message += " of %s (%.1f%%)" % (format_bytes(total_bytes), 100.0 * num_bytes / total_bytes)
+        message += ", %s/s" % format_bytes(rate)
+        if total_bytes and rate > 0:
+            message += ", ETA %ds" % ((total_bytes - num_bytes) / rate)
+        print message
+
+    def write_stream(self, r, fd, total_bytes, report=True):
+        """
+        Write a streamed response to an open file in buffer_size chunks, so the data is never
+        held in memory. Progress is reported at most once per second. Returns the number of
+        bytes written.
+        """
+        num_bytes = 0
+        start = time.time()
+        last_report = start
+        for chunk in r.iter_content(self.buffer_size):
+            fd.write(chunk)
+            num_bytes += len(chunk)
+            now = time.time()
+            if report and now - last_report >= 1:
+                self.report_progress(num_bytes, total_bytes, now - start)
+                last_report = now
+        if report:
+            self.report_progress(num_bytes, total_bytes, time.time() - start)
+        return num_bytes
+
+    def create_output_dir(self):
+        # Create directory if it doesn't exist
+        try:
+            print "Creating output directory %s" % self.output_dir
+            os.makedirs(self.output_dir)
+        except OSError:
+            if not os.path.exists(self.output_dir):
+                raise
+
     def find_files(self):
         """
-        Query API for file ID and fetch XML files
+        Query API for file ID and fetch XML files. The response is streamed to disk in
+        buffer_size chunks, so the archive is never held in memory.
         """
 
         # Setup the rest of the parameters, saying we're looking for matching case UUIDs
         params = {"ids": self.file_ids}
-        r = requests.post(DATA_ENDPOINT, data=json.dumps(params), headers={"content-type":"application/json"})
+        r = self.client.post_json(DATA_ENDPOINT, params, headers=IDENTITY_ENCODING, stream=True)
 
         # outfilename = os.path.join(self.output_dir, "clinical2xml.tar.gz")
         if r.status_code == 200:
             # Get filename
-            import re
             disp = r.headers["content-disposition"]
             fname = re.findall("filename=(.+)", disp)[0]
 
-            # Create directory if it doesn't exist
-            try:
-                print "Creating output directory %s" % self.output_dir
-                os.makedirs(self.output_dir)
-            except OSError:
-                if not os.path.exists(self.output_dir):
-                    raise
+            self.create_output_dir()
+
+            # Size is unknown if the server doesn't send a content-length
+            total_bytes = int(r.headers.get("content-length", 0)) or None
 
             # Write data to file
             output_filename = os.path.join(self.output_dir, fname)
-            with open(output_filename, "wb") as fd:
-                for chunk in r.iter_content(10):
-                    fd.write(chunk)
-                print "File written to %s" % output_filename
+            with gdc_metrics.stage("download") as stage, open(output_filename, "wb") as fd:
+                self.write_stream(r, fd, total_bytes)
+                stage.add(len(self.file_ids))
+            print "File written to %s" % output_filename
         else:
             print "ERROR: Something went wrong. Got HTTP status code %s. Server says:\n%s" % (r.status_code, r.text)
 
+    def read_ledger(self):
+        """
+        Read the completion ledger from the output directory. Returns a dict with
+        key/value shard key/output file name.
+        """
+        completed = {}
+        if os.path.exists(self.ledger_file):
+            with open(self.ledger_file, "r") as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) == 2:
+                        completed[fields[0]] = fields[1]
+        return completed
+
+    def download_shard(self, shard):
+        """
+        Download a single shard of file IDs into the output directory. Data is written to a
+        .part file first, and only renamed to the shard's file name once it has the size the
+        server announced. A partially written .part file is resumed with an HTTP Range
+        request, but only if the server sent a strong ETag or a Last-Modified date for it,
+        which is sent back in If-Range so a changed archive is sent in full. Archives built
+        on the fly have neither, so their downloads start over. Downloads that broke off or
+        couldn't be resumed are retried with exponential backoff, and other HTTP errors fail
+        right away. Returns a tuple of (shard, output file name, error).
+        """
+        index, key, ids = shard
+        part_filename = os.path.join(self.output_dir, "shard_%05d_%s.part" % (index, key))
+        validator_filename = part_filename + ".validator"
+        params = {"ids": ids}
+
+        def start_over():
+            for filename in [part_filename, validator_filename]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+        attempt = 0
+        while True:
+            error = None
+            try:
+                # Resume partially written shards, if the server can tell whether the archive is still the same
+                offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+                validator = None
+                if offset > 0 and os.path.exists(validator_filename):
+                    with open(validator_filename, "r") as f:
+                        validator = f.read().strip() or None
+                if offset > 0 and validator is None:
+                    start_over()
+                    offset = 0
+                headers = dict(IDENTITY_ENCODING)
+                if offset > 0:
+                    headers["Range"] = "bytes=%d-" % offset
+                    headers["If-Range"] = validator
 
-    def handle_arguments(self):
+                r = self.client.post_json(DATA_ENDPOINT, params, headers=headers, stream=True)
+                if r.status_code == 416:
+                    # Requested range can't be satisfied, so start over
+                    r.close()
+                    start_over()
+                    error = "Could not resume download"
+                elif r.status_code == 206 and content_range_start(r.headers.get("content-range")) != offset:
+                    r.close()
+                    start_over()
+                    error = "Server resumed at another byte than %d (Content-Range: %s)" % (offset, r.headers.get("content-range"))
+                elif r.status_code in (200, 206):
+                    if r.status_code == 206:
+                        total_bytes = content_range_total(r.headers.get("content-range"))
+                        mode = "ab"
+                    else:
+                        # The server sent the whole archive, e.g. because it changed, so rewrite the file from scratch
+                        total_bytes = int(r.headers.get("content-length", 0)) or None
+                        mode = "wb"
+                        validator = response_validator(r)
+                        if validator is not None:
+                            with open(validator_filename, "w") as f:
+                                f.write(validator)
+                        elif os.path.exists(validator_filename):
+                            os.remove(validator_filename)
+                    with gdc_metrics.stage("download") as stage, open(part_filename, mode) as fd:
+                        self.write_stream(r, fd, None, report=False)
+                        stage.add(len(ids))
+
+                    # Keep the extension of the file name the server suggests (.xml or .tar.gz)
+                    fname = re.findall("filename=(.+)", r.headers["content-disposition"])[0]
+                    ext = ".tar.gz" if fname.endswith(".tar.gz") else os.path.splitext(fname)[1]
+
+                    # A dropped connection can end the response early without an error
+                    num_bytes = os.path.getsize(part_filename)
+                    if total_bytes is not None and num_bytes != total_bytes:
+                        error = "Download ended after %d of %d bytes" % (num_bytes, total_bytes)
+                    elif total_bytes is None and not is_complete_download(part_filename, ext):
+                        start_over()
+                        error = "Download without a size ended in a truncated file"
+                    else:
+                        output_filename = "shard_%05d_%s%s" % (index, key, ext)
+                        os.rename(part_filename, os.path.join(self.output_dir, output_filename))
+                        if os.path.exists(validator_filename):
+                            os.remove(validator_filename)
+                        return shard, output_filename, None
+                else:
+                    # The client has already retried 5xx, and a 4xx won't get better
+                    return shard, None, "HTTP status code %s. Server says:\n%s" % (r.status_code, r.text)
+            except DOWNLOAD_ERRORS as e:
+                if not is_stream_error(e):
+                    return shard, None, str(e)
+                error = str(e)
+
+            attempt += 1
+            if attempt > self.retries:
+                return shard, None, error
+            gdc_metrics.count("download_retries")
+            time.sleep(2 ** attempt)
+
+    def parse_shard(self, shard):
+        """
+        Download a shard of file IDs and parse it with iter_download_records, retrying failed
+        downloads. Returns a tuple of (shard, parsed patient records, error).
+        """
+        index, key, ids = shard
+        try:
+            return shard, list(iter_download_records(self.client, ids, self.retries)), None
+        except DOWNLOAD_ERRORS as e:
+            return shard, None, str(e)
+
+    def find_files_pipeline(self):
+        """
+        Download file IDs and parse the XML files while they are streaming in, writing the
+        merged clinical data to a TSV file in a single pass. Without shards, records are
+        written as they are parsed. If shard_size is set, shards are downloaded and parsed
+        concurrently, and each shard is written once it and the shards before it are done.
+        """
+        # Create directory if it doesn't exist
+        output_dir = os.path.dirname(os.path.abspath(self.to_tsv))
+        if not os.path.exists(output_dir):
+            print "Creating output directory %s" % output_dir
+            os.makedirs(output_dir)
+
+        shard_size = self.shard_size if self.shard_size > 0 else len(self.file_ids)
+        shards = []
+        for i in range(0, len(self.file_ids), shard_size):
+            shards.append((i / shard_size, "%05d" % (i / shard_size), self.file_ids[i:i + shard_size]))
+        print "Downloading and parsing %d shard(s) of up to %d files, using %d worker(s)" % (len(shards), shard_size, self.workers)
+
+        failed = []
+        def streamed_records():
+            # A single shard goes straight from the download to the output file
+            shard = shards[0]
+            try:
+                for record in iter_download_records(self.client, shard[2], self.retries):
+                    yield record
+            except DOWNLOAD_ERRORS as e:
+                print "ERROR: Shard %s failed: %s" % (shard[1], e)
+                failed.append(shard)
+
+        # Stream records to the output file in shard order, regardless of which shard finishes first
+        def sharded_records():
+            pending = {}
+            next_index = 0
+            pool = ThreadPool(min(self.workers, len(shards)))
+            try:
+                for shard, patient_records, error in pool.imap_unordered(self.parse_shard, shards):
+                    if error is not None:
+                        print "ERROR: Shard %s failed: %s" % (shard[1], error)
+                        failed.append(shard)
+                        patient_records = []
+                    else:
+                        print "Shard %s: parsed %d XML file(s)" % (shard[1], len(patient_records))
+                    pending[shard[0]] = patient_records
+                    while next_index in pending:
+                        for record in pending.pop(next_index):
+                            yield record
+                        next_index += 1
+            finally:
+                pool.close()
+                pool.join()
+
+        records = streamed_records() if len(shards) == 1 else sharded_records()
+        print "Writing file to %s" % self.to_tsv
+        num_records = gdc_xml_parser.write_tsv(records, self.to_tsv)
+        print "Wrote %d patients to %s" % (num_records, self.to_tsv)
+
+        if len(failed) > 0:
+            print "ERROR: %d shard(s) failed, output is incomplete" % len(failed)
+
+    def find_files_sharded(self):
+        """
+        Split file IDs into shards of shard_size and download them concurrently. Completed
+        shards are recorded in a ledger in the output directory, so a rerun only fetches
+        shards that are missing.
+        """
+        self.create_output_dir()
+        completed = self.read_ledger()
+
+        shards = []
+        for i in range(0, len(self.file_ids), self.shard_size):
+            ids = self.file_ids[i:i + self.shard_size]
+            key = hashlib.sha1("\n".join(sorted(ids))).hexdigest()[:12]
+            if key in completed and os.path.exists(os.path.join(self.output_dir, completed[key])):
+                print "Shard %s already downloaded to %s, skipping" % (key, completed[key])
+                continue
+            shards.append((i / self.shard_size, key, ids))
+
+        if len(shards) == 0:
+            print "All shards already downloaded"
+            return
+        print "Downloading %d shard(s) of up to %d files, using %d worker(s)" % (len(shards), self.shard_size, self.workers)
+
+        failed = 0
+        pool = ThreadPool(min(self.workers, len(shards)))
+        try:
+            with open(self.ledger_file, "a") as ledger:
+                for shard, output_filename, error in pool.imap_unordered(self.download_shard, shards):
+                    if error is not None:
+                        print "ERROR: Shard %s failed: %s" % (shard[1], error)
+                        failed += 1
+                        continue
+                    ledger.write("%s\t%s\n" % (shard[1], output_filename))
+                    ledger.flush()
+                    print "Shard %s (%d files) written to %s" % (shard[1], len(shard[2]), os.path.join(self.output_dir, output_filename))
+        finally:
+            pool.close()
+            pool.join()
+
+        if failed > 0:
+            print "ERROR: %d shard(s) failed. Run again with the same arguments to resume." % failed
+
+    def handle_arguments(self, argv=None):
         self.parser = argparse.ArgumentParser()
         self.parser.add_argument("-i", "--input", help="File IDs for clinical data XML files. Can be a single file ID or a comma-serparated list of file IDs", required=False)
         self.parser.add_argument("-f", "--from-file", help="Path to a file containing file IDs to look up. One file ID per line.", required=False)
         self.parser.add_argument("-o", "--output-dir", help="Path to output directory. Missing directories will be created. Default: Current directory", default=os.getcwd(), required=False)
-        args = self.parser.parse_args()
+        self.parser.add_argument("--buffer-size", help="Size in bytes of each chunk written to disk while downloading. Default: 1048576 (1 MB)", type=int, default=1024 * 1024, required=False)
+        self.parser.add_argument("-s", "--shard-size", help="Download file IDs in shards of this many files, concurrently and resumable. Default: 0 (everything in a single download)", type=int, default=0, required=False)
+        self.parser.add_argument("-w", "--workers", help="Number of shards to download concurrently. Default: 4", type=int, default=4, required=False)
+        self.parser.add_argument("--retries", help="Number of times to retry a shard whose download broke off. Connection errors, 429 and 5xx are retried by the HTTP client (--http-retries), and other HTTP errors fail right away. Default: 3", type=int, default=3, required=False)
+        gdc_client.add_client_arguments(self.parser)
+        self.parser.add_argument("-t", "--to-tsv", help="Parse the XML files while downloading and write the merged clinical data to this TSV file, instead of saving the XML files. Nothing else is written to disk.", required=False)
+        gdc_metrics.add_metrics_arguments(self.parser)
+        args = self.parser.parse_args(argv)
+        gdc_metrics.start_from_args(args)
+        self.client = gdc_client.client_from_args(args)
         self.input_arg = args.input
         self.from_file = args.from_file
         self.output_dir = args.output_dir
+        self.buffer_size = args.buffer_size
+        self.shard_size = args.shard_size
+        self.workers = args.workers
+        self.retries = args.retries
+        self.to_tsv = args.to_tsv
 
     def validate_arguments(self):
         # Check which input options are set
@@ -105,27 +527,56 @@ class File2Case(object):
                     print "ERROR: Could not create output directory"
                     raise
 
-    def __init__(self):
+    def __init__(self, file_ids=None, output_dir=None, buffer_size=1024 * 1024, shard_size=0, workers=4, retries=3, to_tsv=None, client=None):
         self.parser = None
         self.input_arg = None
-        self.file_ids = None
+        self.file_ids = file_ids
         self.from_file = None
-        self.output_file = None
+        self.output_dir = output_dir
+        self.buffer_size = buffer_size
+        self.shard_size = shard_size
+        self.workers = workers
+        self.retries = retries
+        self.ledger_file = None
+        self.to_tsv = to_tsv
+        self.client = client
 
-        # Handle args
-        self.handle_arguments()
-        self.validate_arguments()
-
-        # Feedback to user: Tell them which files we think we're meant to use
-        print "Provided file IDs:"
-        for f in self.file_ids:
-            print "File id --> %s" % f
+    def run(self):
+        """
+        Download file_ids to output_dir, as a single download or in shards, or parse them
+        straight into the to_tsv file if it is set
+        """
+        if self.client is None:
+            self.client = gdc_client.GDCClient()
+        if self.output_dir is None:
+            self.output_dir = os.getcwd()
+        self.ledger_file = os.path.join(self.output_dir, LEDGER_FILENAME)
 
         # Query API
-        self.find_files()
+        if self.to_tsv:
+            self.find_files_pipeline()
+        elif self.shard_size > 0:
+            self.find_files_sharded()
+        else:
+            self.find_files()
+
+@gdc_metrics.instrumented("gdc_clinical2xml")
+def main(argv=None):
+    clinical2xml = File2Case()
+
+    # Handle args
+    clinical2xml.handle_arguments(argv)
+    clinical2xml.validate_arguments()
+
+    # Feedback to user: Tell them which files we think we're meant to use
+    print "Provided file IDs:"
+    for f in clinical2xml.file_ids:
+        print "File id --> %s" % f
+
+    clinical2xml.run()
 
 if __name__ == "__main__":
-    file2case = File2Case()
+    main()
 
 
 
@@ -0,0 +1,181 @@
+import os
+import sys
+import argparse
+import hashlib
+import sqlite3
+from multiprocessing.pool import ThreadPool
+import gdc_cache
+import gdc_exclude
+import gdc_metrics
+
+DEFAULT_INDEX_FILE = os.path.join(gdc_cache.CACHE_DIR, "downloads.sqlite")
+DEFAULT_JOBS = 4
+
+# hashlib releases the GIL while hashing blocks this big, so files are hashed in parallel threads
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+def file_md5(filepath):
+    """
+    Return the MD5 hex digest of a file's content
+    """
+    md5 = hashlib.md5()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), ""):
+            md5.update(block)
+    return md5.hexdigest()
+
+def find_downloads(roots):
+    """
+    Yield (path, file UUID, file name) for every downloaded file under roots. The file UUID
+    is taken from the directory the GDC Transfer Tool puts each file in, <file UUID>/<file
+    name>, and is None for files that are not in such a directory. Partial downloads are
+    skipped.
+    """
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirname = os.path.basename(dirpath)
+            file_id = dirname if gdc_exclude.UUID_PATTERN.match(dirname) else None
+            for filename in filenames:
+                if filename.endswith(gdc_exclude.PARTIAL_SUFFIXES):
+                    continue
+                yield os.path.abspath(os.path.join(dirpath, filename)), file_id, filename
+
+class DownloadIndex(object):
+    """
+    SQLite index of downloaded files, with the path, size, mtime and MD5 of each file and
+    the file UUID it was downloaded as. MD5s are only computed for files that are new or
+    have a new size or mtime since the last scan, so rescanning a large archive is cheap.
+    """
+
+    def __init__(self, index_filepath=DEFAULT_INDEX_FILE):
+        # Create directory if it doesn't exist
+        index_dir = os.path.dirname(os.path.abspath(index_filepath))
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+
+        self.conn = sqlite3.connect(index_filepath, timeout=30)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, file_id TEXT, file_name TEXT, size INTEGER, mtime REAL, md5 TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS files_file_id ON files (file_id)")
+        self.conn.commit()
+
+    def scan(self, roots, jobs=DEFAULT_JOBS):
+        """
+        Bring the index up to date with the files under roots: hash new and changed files on
+        jobs threads, and remove files that are gone. Returns a tuple of (number of files,
+        number of files hashed, number of files removed).
+        """
+        roots = [os.path.abspath(root) for root in roots]
+        known = {}
+        for path, size, mtime in self.conn.execute("SELECT path, size, mtime FROM files"):
+            if any(path.startswith(root + os.sep) for root in roots):
+                known[path] = (size, mtime)
+
+        # Only hash files that are new or changed
+        num_files = 0
+        to_hash = []
+        with gdc_metrics.stage("scan") as stage:
+            for path, file_id, file_name in find_downloads(roots):
+                num_files += 1
+                stat = os.stat(path)
+                if known.pop(path, None) != (stat.st_size, stat.st_mtime):
+                    to_hash.append((path, file_id, file_name, stat.st_size, stat.st_mtime))
+            stage.add(num_files)
+
+        # Whatever is left in the index has been deleted
+        if len(known) > 0:
+            self.conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in known])
+            self.conn.commit()
+
+        if len(to_hash) > 0:
+            print "INFO: Hashing %d new or changed file(s) of %d, using %d thread(s)" % (len(to_hash), num_files, jobs)
+            def hash_file(entry):
+                try:
+                    return entry, file_md5(entry[0]), None
+                except (IOError, OSError) as e:
+                    return entry, None, e
+
+            pool = ThreadPool(jobs)
+            try:
+                with gdc_metrics.stage("hash") as stage:
+                    for i, (entry, md5, error) in enumerate(pool.imap_unordered(hash_file, to_hash)):
+                        path, file_id, file_name, size, mtime = entry
+                        if error is not None:
+                            print "ERROR: Could not hash %s (%s). Skipping." % (path, error)
+                            continue
+                        stage.add()
+                        gdc_metrics.count("bytes_hashed", size)
+                        self.conn.execute("INSERT OR REPLACE INTO files (path, file_id, file_name, size, mtime, md5) VALUES (?, ?, ?, ?, ?, ?)",
+                                          (path, file_id, file_name, size, mtime, md5))
+                        if (i + 1) % 100 == 0:
+                            self.conn.commit()
+                            print "INFO: Hashed %d of %d file(s)" % (i + 1, len(to_hash))
+            finally:
+                pool.close()
+                pool.join()
+                self.conn.commit()
+        return num_files, len(to_hash), len(known)
+
+    def lookup(self, file_id):
+        """
+        Return a list of (path, size, MD5) tuples of the downloads of a file UUID
+        """
+        return self.conn.execute("SELECT path, size, md5 FROM files WHERE file_id = ?", (file_id,)).fetchall()
+
+    def md5s(self):
+        """
+        Return the set of MD5s of all downloaded files
+        """
+        return set(md5 for (md5,) in self.conn.execute("SELECT md5 FROM files"))
+
+    def close(self):
+        self.conn.close()
+
+def add_download_index_arguments(parser):
+    """
+    Add arguments for the download index to an argparse parser
+    """
+    parser.add_argument("--download-root", help="Directory with downloaded files. Scanned into the download index before searching, and files that are already there with the right md5 are left out. Can be repeated.", action="append", required=False)
+    parser.add_argument("--skip-downloaded", help="Leave out files that are in the download index with the right md5, without scanning first.", action="store_true", default=False, required=False)
+    parser.add_argument("--download-index", help="Path to the download index (SQLite). Default: %s" % DEFAULT_INDEX_FILE, default=DEFAULT_INDEX_FILE, required=False)
+    parser.add_argument("--hash-jobs", help="Number of files to hash in parallel when scanning. Default: %d" % DEFAULT_JOBS, type=int, default=DEFAULT_JOBS, required=False)
+
+def download_index_from_args(args):
+    """
+    Create a DownloadIndex from arguments added with add_download_index_arguments, scanning
+    the download roots if any, or return None if downloaded files are not to be skipped
+    """
+    if not args.download_root and not args.skip_downloaded:
+        return None
+    for root in args.download_root or []:
+        if not os.path.isdir(root):
+            print "ERROR: Provided download root (%s) does not seem to be a directory. Exiting" % root
+            sys.exit()
+    index = DownloadIndex(args.download_index)
+    if args.download_root:
+        num_files, num_hashed, num_removed = index.scan(args.download_root, args.hash_jobs)
+        print "INFO: %d downloaded file(s) in %s, %d hashed, %d removed from the index" % (num_files, ", ".join(args.download_root), num_hashed, num_removed)
+    return index
+
+@gdc_metrics.instrumented("gdc_download_index")
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index downloaded GDC files with their MD5s, so manifests can leave them out.")
+    parser.add_argument("roots", help="Directories with downloaded files, e.g. as written by the GDC Transfer Tool.", nargs="+")
+    parser.add_argument("-i", "--index-file", help="Path to the download index (SQLite). Default: %s" % DEFAULT_INDEX_FILE, default=DEFAULT_INDEX_FILE)
+    parser.add_argument("-j", "--jobs", help="Number of files to hash in parallel. Default: %d" % DEFAULT_JOBS, type=int, default=DEFAULT_JOBS)
+    gdc_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+    gdc_metrics.start_from_args(args)
+
+    for root in args.roots:
+        if not os.path.isdir(root):
+            print "ERROR: Provided directory (%s) does not seem to exist. Exiting" % root
+            sys.exit()
+
+    index = DownloadIndex(args.index_file)
+    num_files, num_hashed, num_removed = index.scan(args.roots, args.jobs)
+    index.close()
+    print "INFO: Indexed %d file(s), hashed %d new or changed file(s), removed %d deleted file(s)" % (num_files, num_hashed, num_removed)
+    print "INFO: Index written to %s" % args.index_file
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+import time
+import threading
+import collections
+import Queue
+from multiprocessing.pool import ThreadPool
+import requests
+import gdc_metrics
+
+DEFAULT_WORKERS = 4
+DEFAULT_RETRIES = 3
+DEFAULT_RATE_LIMIT = 0  # Requests per second, 0 means no limit
+
+# Errors of a response that broke off while it was being read. The client retries connection
+# errors, 429 and 5xx itself, but can't retry a response it has already handed back.
+RETRY_ERRORS = (requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError)
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket rate limiter. Tokens are added at rate per second, up to
+    burst tokens, and acquire() blocks until a token is available.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class QueryEngine(object):
+    """
+    Runs many API queries concurrently on a fixed pool of worker threads. The number of
+    requests in flight is bounded by the number of workers, requests are spread out by
+    an optional token bucket rate limiter, and responses that break off while they are
+    read are retried with exponential backoff. Connection errors, 429 and 5xx are retried
+    by the client, so they aren't retried again here. Results of independent jobs are
+    handed back as they complete.
+    """
+
+    def __init__(self, client, workers=DEFAULT_WORKERS, retries=DEFAULT_RETRIES, rate_limit=DEFAULT_RATE_LIMIT):
+        self.client = client
+        self.workers = workers
+        self.retries = retries
+        self.bucket = None
+        if rate_limit > 0:
+            self.bucket = TokenBucket(rate_limit)
+        self.pool = ThreadPool(workers)
+
+    def query(self, url, params):
+        """
+        Query a search endpoint through the rate limiter, retrying responses that broke off
+        while they were read. Raises the last error if every attempt fails, and any other
+        error right away, e.g. the HTTPError for a 4xx caused by a bad filter.
+        """
+        attempt = 0
+        while True:
+            if self.bucket is not None:
+                self.bucket.acquire()
+            try:
+                return self.client.query(url, params)
+            except RETRY_ERRORS:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                gdc_metrics.count("query_retries")
+                time.sleep(2 ** attempt)
+
+    def query_all(self, url, params, page_size):
+        """
+        Page through a query using from/size and return the hits from every page
+        """
+        hits = []
+        offset = 0
+        while True:
+            page_params = dict(params)
+            page_params["from"] = offset
+            page_params["size"] = page_size
+            data = self.query(url, page_params)["data"]
+            hits.extend(data["hits"])
+
+            pagination = data["pagination"]
+            offset = pagination["from"] + pagination["count"]
+            if pagination["count"] == 0 or offset >= pagination["total"]:
+                return hits
+
+    def map_unordered(self, func, items):
+        """
+        Call func on every item concurrently and yield (item, result, error) tuples in the
+        order they complete. error is None on success. Items are submitted lazily, and no
+        more than twice the number of workers are pending at a time, so unconsumed results
+        don't pile up in memory.
+        """
+        results = Queue.Queue()
+        slots = threading.BoundedSemaphore(self.workers * 2)
+        submitted = [0]
+        done = threading.Event()
+
+        def call(item):
+            try:
+                results.put((item, func(item), None))
+            except Exception as e:
+                results.put((item, None, e))
+
+        def submit():
+            for item in items:
+                slots.acquire()
+                submitted[0] += 1
+                self.pool.apply_async(call, (item,))
+            done.set()
+            results.put(None)
+
+        producer = threading.Thread(target=submit)
+        producer.daemon = True
+        producer.start()
+
+        received = 0
+        while not done.is_set() or received < submitted[0]:
+            result = results.get()
+            if result is None:
+                continue
+            received += 1
+            slots.release()
+            yield result
+
+    def iter_pages(self, url, params, page_size, max_results=None):
+        """
+        Yield the hits of a paged query one page at a time, in order. The first page tells
+        how many results there are, and the remaining pages are then fetched concurrently,
+        with a bounded number of pages fetched ahead of the one being yielded. The server
+        can return fewer hits than asked for, so pages are planned from the count of the
+        first page, and the rest of a page that comes back short is fetched before moving
+        on. Stops after max_results hits if set.
+        """
+        first_size = page_size if max_results is None else min(page_size, max_results)
+        if first_size <= 0:
+            return
+        first_params = dict(params)
+        first_params["from"] = 0
+        first_params["size"] = first_size
+        data = self.query(url, first_params)["data"]
+        yield data["hits"]
+
+        pagination = data["pagination"]
+        total = pagination["total"]
+        if max_results is not None:
+            total = min(total, max_results)
+        offset = pagination["from"] + pagination["count"]
+        if pagination["count"] == 0:
+            return
+        if pagination["count"] < first_size:
+            # The server has a smaller maximum page size than asked for
+            page_size = pagination["count"]
+
+        pending = collections.deque()
+        while offset < total or pending:
+            # Keep a window of pages in flight ahead of the one being yielded
+            while offset < total and len(pending) < self.workers * 2:
+                page_params = dict(params)
+                page_params["from"] = offset
+                page_params["size"] = min(page_size, total - offset)
+                pending.append((page_params, self.pool.apply_async(self.query, (url, page_params))))
+                offset += page_params["size"]
+            page_params, result = pending.popleft()
+            data = result.get()["data"]
+            yield data["hits"]
+
+            # Fetch the rest of a short page, so no results are skipped
+            start = page_params["from"] + data["pagination"]["count"]
+            end = page_params["from"] + page_params["size"]
+            while data["pagination"]["count"] > 0 and start < end:
+                gdc_metrics.count("short_pages")
+                rest_params = dict(params)
+                rest_params["from"] = start
+                rest_params["size"] = end - start
+                data = self.query(url, rest_params)["data"]
+                yield data["hits"]
+                start += data["pagination"]["count"]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+def add_engine_arguments(parser):
+    """
+    Add arguments for the query engine to an argparse parser
+    """
+    parser.add_argument("-w", "--workers", help="Number of API requests to run concurrently. Default: %d" % DEFAULT_WORKERS, type=int, default=DEFAULT_WORKERS, required=False)
+    parser.add_argument("--retries", help="Number of times to retry a query whose response broke off while it was read. Connection errors, 429 and 5xx are retried by the HTTP client (--http-retries). Default: %d" % DEFAULT_RETRIES, type=int, default=DEFAULT_RETRIES, required=False)
+    parser.add_argument("--rate-limit", help="Maximum number of API requests per second, 0 for no limit. Default: %d" % DEFAULT_RATE_LIMIT, type=float, default=DEFAULT_RATE_LIMIT, required=False)
+
+def engine_from_args(args, client):
+    """
+    Create a QueryEngine from arguments added with add_engine_arguments
+    """
+    return QueryEngine(client, workers=args.workers, retries=args.retries, rate_limit=args.rate_limit)
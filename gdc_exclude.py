@@ -0,0 +1,176 @@
+import os
+import re
+import sys
+import mmap
+import struct
+import hashlib
+import itertools
+
+UUID_PATTERN = re.compile("^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+# Fields of a search hit that are looked up in an exclude set
+HIT_FIELDS = ["file_id", "file_name", "md5sum"]
+
+# Index files start with a magic string and the number of keys, followed by the sorted keys
+INDEX_MAGIC = "GDCXIDX1"
+HEADER_SIZE = len(INDEX_MAGIC) + 8
+KEY_SIZE = 8
+
+# Partially downloaded files, which shouldn't count as downloaded
+PARTIAL_SUFFIXES = (".partial", ".part")
+
+def read_keys(source):
+    """
+    Yield the file UUIDs, file names and md5 sums to exclude from a source, which is one of:
+    a directory of downloaded files (gdc-client stores each file as <file UUID>/<file name>),
+    a manifest with id, filename and md5 columns, or a text file with one name or UUID per line
+    """
+    if os.path.isdir(source):
+        for dirpath, dirnames, filenames in os.walk(source):
+            downloaded = [f for f in filenames if not f.endswith(PARTIAL_SUFFIXES)]
+            for filename in downloaded:
+                yield filename
+            if downloaded and UUID_PATTERN.match(os.path.basename(dirpath)):
+                yield os.path.basename(dirpath)
+        return
+
+    with open(source, "r") as f:
+        first_line = f.readline()
+        header = first_line.rstrip("\n").split("\t")
+        if "id" in header and "filename" in header:
+            columns = [header.index(column) for column in ["id", "filename", "md5"] if column in header]
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                for i in columns:
+                    if i < len(fields) and fields[i]:
+                        yield fields[i]
+        else:
+            for line in itertools.chain([first_line], f):
+                if line.strip():
+                    yield line.strip()
+
+def key_digest(key):
+    """
+    Return the fixed-size digest a key is stored as in an ExcludeIndex
+    """
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return hashlib.md5(key).digest()[:KEY_SIZE]
+
+class ExcludeSet(object):
+    """
+    In-memory hashed set of file UUIDs, file names and md5 sums to exclude
+    """
+
+    def __init__(self, keys=()):
+        self.keys = set(keys)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def close(self):
+        pass
+
+class ExcludeIndex(object):
+    """
+    Memory-mapped index file of sorted 8-byte digests of the file UUIDs, file names and md5
+    sums to exclude, searched with binary search. Only the pages that are touched are read,
+    so it can be used with any number of keys and shared between runs. Two keys with the
+    same digest are practically impossible, but would make a file count as excluded.
+    """
+
+    def __init__(self, index_filepath):
+        self.file = open(index_filepath, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise ValueError("%s is not an exclude index" % index_filepath)
+        self.num_keys = struct.unpack(">Q", self.mm[len(INDEX_MAGIC):HEADER_SIZE])[0]
+
+    @staticmethod
+    def build(keys, index_filepath):
+        """
+        Write an index of keys to index_filepath. Returns the number of unique keys.
+        """
+        digests = sorted(set(key_digest(key) for key in keys))
+
+        # Write to a temporary file first, so a failed build never replaces a good index
+        tmp_filepath = "%s.%d.tmp" % (index_filepath, os.getpid())
+        with open(tmp_filepath, "wb") as f:
+            f.write(INDEX_MAGIC)
+            f.write(struct.pack(">Q", len(digests)))
+            f.write("".join(digests))
+        os.rename(tmp_filepath, index_filepath)
+        return len(digests)
+
+    def __contains__(self, key):
+        digest = key_digest(key)
+        lo, hi = 0, self.num_keys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = HEADER_SIZE + mid * KEY_SIZE
+            value = self.mm[offset:offset + KEY_SIZE]
+            if value < digest:
+                lo = mid + 1
+            elif value > digest:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def __len__(self):
+        return self.num_keys
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+def is_excluded(excludes, hit):
+    """
+    Return True if the file UUID, file name or md5 sum of a search hit is in any of a list
+    of ExcludeSets and ExcludeIndexes
+    """
+    for field in HIT_FIELDS:
+        value = hit.get(field)
+        if value and any(value in exclude for exclude in excludes):
+            return True
+    return False
+
+def add_exclude_arguments(parser):
+    """
+    Add arguments for client-side exclusion to an argparse parser
+    """
+    parser.add_argument("--exclude-from", help="Exclude files that are in this manifest, text file with one name or UUID per line, or download directory, by UUID, name or md5. Checked while paging, not sent to the API. Can be repeated.", action="append", required=False)
+    parser.add_argument("--exclude-index", help="Path to an index file of files to exclude. Built from --exclude-from if given, otherwise an index built before is used.", required=False)
+
+def exclude_from_args(args):
+    """
+    Create an ExcludeSet or ExcludeIndex from arguments added with add_exclude_arguments,
+    or return None if nothing is excluded. Exits if a source or the index can't be read.
+    """
+    sources = args.exclude_from or []
+    for source in sources:
+        if not os.path.exists(source):
+            print "ERROR: Provided exclude source (%s) does not seem to exist. Exiting" % source
+            sys.exit()
+
+    def keys():
+        for source in sources:
+            print "INFO: Reading files to exclude from %s" % source
+            for key in read_keys(source):
+                yield key
+
+    if args.exclude_index:
+        if sources:
+            num_keys = ExcludeIndex.build(keys(), args.exclude_index)
+            print "INFO: Wrote exclude index with %d key(s) to %s" % (num_keys, args.exclude_index)
+        try:
+            return ExcludeIndex(args.exclude_index)
+        except (IOError, ValueError) as e:
+            print "ERROR: Could not open exclude index %s: %s. Exiting" % (args.exclude_index, e)
+            sys.exit()
+    if sources:
+        return ExcludeSet(keys())
+    return None
@@ -3,73 +3,140 @@ import json
 import sys
 import argparse
 import os
+import gdc_client
+import gdc_cache
+import gdc_engine
+import gdc_metrics
+from gdc_client import CASES_ENDPOINT
 
 # TODO: Output file as argument.
 # TODO: Move to scripts/tcga_tools/something.py and add to Git
-# TODO: Handle request response status codes
 # TODO: Print response warnings, if any
 
-CASES_ENDPOINT = "https://gdc-api.nci.nih.gov/cases"
 
 class File2Case(object):
 
-    def find_cases(self):
+    def query_batch(self, batch):
         """
-        Query API for file_name and return cases with files matching provided filenames
+        Query API for the cases matching a single batch of file names/UUIDs. The filter is sent
+        as a JSON body in a POST request, so batches are not limited by URL length.
         """
-        if self.bam:
-            print "Finding case UUIDs matching provided BAM filenames"
-        else:
-            print "Finding case UUIDs matching provided file UUIDs"
-
         # First, create a filter saying we're providing file names
         filters = {
-            "op":"=",
+            "op":"in",
             "content": {
                 "field": self.query_field,
-                "value": self.input_files
+                "value": batch
             }
         }
 
         # Setup the rest of the parameters, saying we're looking for matching case UUIDs
         params = {
-            "filters": json.dumps(filters),
+            "filters": filters,
             "fields": self.result_field,
-            "format": "json",
-            "pretty": "true"
+            "format": "json"
         }
 
-        # Perform HTTP GET request
-        response = requests.get(CASES_ENDPOINT, params=params)
+        # Files can belong to more than one case, so there may be more than one page
+        return self.engine.query_all(CASES_ENDPOINT, params, len(batch))
 
-        # Parse API response
-        data = response.json()["data"]
+    def find_cases(self):
+        """
+        Query API for file_name and return cases with files matching provided filenames.
+        Files found in the mapping store are not queried again. The rest are split into
+        batches that are queried concurrently, and their cases are added to the store.
+        """
+        if self.bam:
+            print "Finding case UUIDs matching provided BAM filenames"
+        else:
+            print "Finding case UUIDs matching provided file UUIDs"
 
-        # Debug: Print entire response
-        # print json.dumps(response.json(), indent=2)
+        # Index of input file name/UUID to the case UUIDs it belongs to, built from the mapping store and all batches
+        input_set = set(self.input_files)
+        file_index = {}
+        memo_kind = "%s:case_id" % self.id_or_name
+        if self.memo is not None and not self.refresh:
+            file_index = self.memo.lookup(memo_kind, input_set)
+            print "Found %d of %d file(s) in the mapping store" % (len(file_index), len(input_set))
+            gdc_metrics.count("memo_hits", len(file_index))
+
+        # Only query the API for files that haven't been resolved before
+        pending = []
+        pending_set = set()
+        for input_file in self.input_files:
+            if input_file not in file_index and input_file not in pending_set:
+                pending.append(input_file)
+                pending_set.add(input_file)
+        batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+        resolved = []  # New (file, case UUID) pairs to record in the mapping store
+        failed = set()  # Input files in batches that failed, which were never looked up
+
+        if batches:
+            print "Querying API in %d batch(es) of up to %d files, using %d worker(s)" % (len(batches), self.batch_size, self.workers)
+            for batch, hits, error in self.engine.map_unordered(self.query_batch, batches):
+                if error is not None:
+                    print "ERROR: Batch failed: %s" % error
+                    self.failed_batches += 1
+                    failed.update(batch)
+                    continue
+
+                # Index the provided files found in the results. Cases list all their files,
+                # so only keep the ones we asked for.
+                for result in hits:
+                    case_id = result["case_id"]
+                    for f in result["files"]:
+                        name = f[self.id_or_name]
+                        if name in pending_set:
+                            # A case can show up in several batches when its files are spread across them
+                            case_ids = file_index.setdefault(name, [])
+                            if case_id not in case_ids:
+                                case_ids.append(case_id)
+                                resolved.append((name, case_id))
+
+        if self.memo is not None and resolved:
+            self.memo.store(memo_kind, resolved)
+
+        # Join input files against the index, keeping input order and every match. Files
+        # without a match are only unmatched if their batch was looked up.
+        seen = set()
+        for input_file in self.input_files:
+            if input_file in seen:
+                continue
+            seen.add(input_file)
+            if input_file in file_index:
+                for case_id in file_index[input_file]:
+                    self.results.append((input_file, case_id))
+            elif input_file in failed:
+                self.not_looked_up.append(input_file)
+            else:
+                self.unmatched.append(input_file)
 
-        # Check for matching results
-        if len(data["hits"]) == 0:
+        if len(self.results) == 0 and self.failed_batches == 0:
             print "No results from API"
-            return
-
-        # Check for provided BAM files in the results
-        for result in data["hits"]:
-            case_id = result["case_id"]
-            response_files = [r[self.id_or_name] for r in result["files"]]
-            for bam in self.input_files:
-                if bam in response_files:
-                    self.results[case_id] = bam
 
-    def handle_arguments(self):
+    def handle_arguments(self, argv=None):
         self.parser = argparse.ArgumentParser()
         self.parser.add_argument("-i", "--input", help="File(s) to lookup. Can be a single file name or a comma-serparated list of file names", required=False)
         self.parser.add_argument("-f", "--from-file", help="Path to a file containing file names to look up. One file name per line, and either only BAM-files or only file UUIDs, not a mix of those.", required=False)
         self.parser.add_argument("-o", "--output-file", help="Path to output file. Missing directories will be created. Default: Current directory/results.tsv", default=os.path.join(os.getcwd(), "results.tsv"), required=False)
-        args = self.parser.parse_args()
+        self.parser.add_argument("-b", "--batch-size", help="Number of files to look up per API request. Default: 500", type=int, default=500, required=False)
+        gdc_client.add_client_arguments(self.parser)
+        gdc_cache.add_cache_arguments(self.parser)
+        gdc_cache.add_memo_arguments(self.parser)
+        gdc_engine.add_engine_arguments(self.parser)
+        gdc_metrics.add_metrics_arguments(self.parser)
+        args = self.parser.parse_args(argv)
+        gdc_metrics.start_from_args(args)
+        self.client = gdc_client.client_from_args(args)
+        self.engine = gdc_engine.engine_from_args(args, self.client)
+        self.memo = gdc_cache.memo_from_args(args)
+        self.refresh = args.refresh
         self.input_arg = args.input
         self.from_file = args.from_file
         self.output_file = args.output_file
+        self.batch_size = args.batch_size
+        self.workers = args.workers
+        self.retries = args.retries
 
     def validate_arguments(self):
         # Check which input options are set
@@ -97,7 +164,10 @@ class File2Case(object):
             # Now everything seems fine, read each line as a file name
             with open(self.from_file, "r") as f:
                 print "Reading file names from file (%s)" % self.from_file
-                self.input_files = [line.strip() for line in f.readlines()]
+                self.input_files = [line.strip() for line in f.readlines() if line.strip()]
+            if not self.input_files:
+                print "ERROR: Provided file (%s) does not contain any file names. Exiting." % self.from_file
+                sys.exit()
 
         # Read file names from input argument
         if self.input_arg:
@@ -129,52 +199,123 @@ class File2Case(object):
                 print "We're dealing with file UUIDs"
 
 
-    def __init__(self):
+    def __init__(self, input_files=None, output_file=None, batch_size=500, workers=gdc_engine.DEFAULT_WORKERS, retries=gdc_engine.DEFAULT_RETRIES, client=None, engine=None, memo=None, refresh=False):
         self.parser = None
         self.input_arg = None
         self.bam = False
-        self.input_files = None
+        self.input_files = input_files
         self.from_file = None
-        self.output_file = None
+        self.output_file = output_file
+        self.batch_size = batch_size
+        self.workers = workers
+        self.retries = retries
+        self.failed_batches = 0
+        self.client = client
+        self.engine = engine
+        self.memo = memo
+        self.refresh = refresh
         self.id_or_name = "file_id"
         self.query_field = "files.file_id"
         self.result_field = "case_id,files.file_id"
-        self.results = {}  # Dict of results with key/value case_id/bamfile_or_uuid
+        self.results = []  # List of (bamfile_or_uuid, case_id) tuples
+        self.unmatched = []  # Input files without a matching case
+        self.not_looked_up = []  # Input files in batches that failed
 
-        # Handle args
-        self.handle_arguments()
-        self.validate_arguments()
+    def run(self):
+        """
+        Look up the cases of input_files. Returns a list of (file name/UUID, case UUID) tuples
+        in input order. Input files without a matching case are listed in self.unmatched,
+        and input files in batches that failed in self.not_looked_up. Without an engine,
+        one is created for the run and closed when it is done.
+        """
+        self.results = []
+        self.unmatched = []
+        self.not_looked_up = []
+        self.failed_batches = 0
+        if not self.input_files:
+            return self.results
 
         # Check if we're dealing with BAM files or file IDs
+        self.bam = self.input_files[0].lower().endswith(".bam")
         if self.bam:
             self.id_or_name = "file_name"
             self.query_field = "files.file_name"
             self.result_field = "case_id,files.file_name"
-
-        # Feedback to user: Tell them which files we think we're meant to use
-        print "Provided input files:"
-        for f in self.input_files:
-            print "File --> %s" % f
+        else:
+            self.id_or_name = "file_id"
+            self.query_field = "files.file_id"
+            self.result_field = "case_id,files.file_id"
 
         # Query API
-        self.find_cases()
+        if self.client is None:
+            self.client = gdc_client.GDCClient()
+        own_engine = self.engine is None
+        if own_engine:
+            self.engine = gdc_engine.QueryEngine(self.client, workers=self.workers, retries=self.retries)
+        try:
+            with gdc_metrics.stage("find_cases") as stage:
+                self.find_cases()
+                stage.add(len(self.input_files))
+        finally:
+            if own_engine:
+                self.engine.close()
+                self.engine = None
+        return self.results
+
+    def write_results(self):
+        """
+        Save results to a TSV file
+        """
+        with gdc_metrics.stage("write") as stage, open(self.output_file, "w") as out_file:
+            out_file.write("%s\t%s\n" % (self.id_or_name.upper(), "CASE UUID"))
+            for result_file, case_id in self.results:
+                out_file.write("%s\t%s\n" % (result_file, case_id))
+                stage.add()
 
-        # Print results to stdout
-        if len(self.results) == 0:
-            print "No results found"
-            sys.exit()
+@gdc_metrics.instrumented("gdc_file2case")
+def main(argv=None):
+    file2case = File2Case()
 
-        print "\n{0:60}{1:60}".format(self.id_or_name.upper(), "CASE UUID")
-        for case_id, result_file in self.results.items():
-            print "{0:60}{1:60}".format(result_file, case_id)
+    # Handle args
+    file2case.handle_arguments(argv)
+    file2case.validate_arguments()
 
-        # Save it to a TSV file
-        with open(self.output_file, "w") as out_file:
-            out_file.write("%s\t%s\n" % (self.id_or_name.upper(), "CASE UUID"))
-            for case_id, result_file in self.results.items():
-                out_file.write("%s\t%s\n" % (result_file, case_id))
+    # Feedback to user: Tell them which files we think we're meant to use
+    print "Provided input files:"
+    for f in file2case.input_files:
+        print "File --> %s" % f
 
-        print "\nWrote results to %s" % self.output_file
+    # Query API
+    file2case.run()
+    file2case.engine.close()
+
+    # Print results to stdout
+    if len(file2case.results) == 0:
+        if len(file2case.not_looked_up) > 0:
+            print "ERROR: No results found, and %d input file(s) were not looked up, because their batch failed" % len(file2case.not_looked_up)
+        else:
+            print "No results found"
+        sys.exit()
+    if file2case.failed_batches > 0:
+        print "WARNING: %d batch(es) failed, results are incomplete" % file2case.failed_batches
+
+    print "\n{0:60}{1:60}".format(file2case.id_or_name.upper(), "CASE UUID")
+    for result_file, case_id in file2case.results:
+        print "{0:60}{1:60}".format(result_file, case_id)
+
+    # Report input files without a match
+    if len(file2case.unmatched) > 0:
+        print "\nWARNING: %d input file(s) did not match any case:" % len(file2case.unmatched)
+        for f in file2case.unmatched:
+            print "Unmatched --> %s" % f
+    if len(file2case.not_looked_up) > 0:
+        print "\nWARNING: %d input file(s) were not looked up, because their batch failed:" % len(file2case.not_looked_up)
+        for f in file2case.not_looked_up:
+            print "Not looked up --> %s" % f
+
+    # Save it to a TSV file
+    file2case.write_results()
+    print "\nWrote results to %s" % file2case.output_file
 
 # TODO Future: Can I get a list of BAM-files that are of a certain type (e.g. COAD)
 #              and for a certain experiment (e.g. RNA-seq), and over a certain size
@@ -183,7 +324,7 @@ class File2Case(object):
 #              by the gdc-client on Abel to efficiently download everything?
 
 if __name__ == "__main__":
-    file2case = File2Case()
+    main()
 
 
 
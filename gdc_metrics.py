@@ -0,0 +1,252 @@
+import sys
+import json
+import time
+import pstats
+import cProfile
+import datetime
+import threading
+import functools
+import urlparse
+
+PROFILERS = ["cprofile", "pyinstrument"]
+
+def percentile(values, p):
+    """
+    Return the p-th percentile of values, by nearest rank
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[int(round(p / 100.0 * (len(ordered) - 1)))]
+
+class Stage(object):
+    """
+    Context manager timing one run of a stage. Count the items it handles with add(), to
+    get a rate in items per second.
+    """
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.items = 0
+        self.start = None
+
+    def add(self, n=1):
+        self.items += n
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.add_stage(self.name, self.start, time.time(), self.items)
+        return False
+
+class Metrics(object):
+    """
+    Timings of the stages of a run and of every API request, with bytes transferred,
+    retries and counters. Safe to share between threads. Stages with the same name, e.g.
+    run by several worker threads, are added up: seconds is the total time spent in the
+    stage and wall_seconds the time from its first start to its last end.
+    """
+
+    def __init__(self, tool=None):
+        self.lock = threading.Lock()
+        self.reset(tool)
+
+    def reset(self, tool=None):
+        with self.lock:
+            self.tool = tool
+            self.started = time.time()
+            self.stages = {}
+            self.requests = {}
+            self.counters = {}
+
+    def stage(self, name):
+        return Stage(self, name)
+
+    def add_stage(self, name, start, end, items=0):
+        with self.lock:
+            stage = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "items": 0, "first_start": start, "last_end": end})
+            stage["calls"] += 1
+            stage["seconds"] += end - start
+            stage["items"] += items
+            stage["first_start"] = min(stage["first_start"], start)
+            stage["last_end"] = max(stage["last_end"], end)
+
+    def add_request(self, method, url, status, seconds, num_bytes=0, retries=0):
+        """
+        Record an API request. status is None for requests that failed without a response.
+        """
+        key = "%s %s" % (method.upper(), urlparse.urlparse(url).path)
+        with self.lock:
+            request = self.requests.setdefault(key, {"count": 0, "errors": 0, "seconds": 0.0, "bytes": 0, "retries": 0, "latencies": []})
+            request["count"] += 1
+            if status is None or status >= 400:
+                request["errors"] += 1
+            request["seconds"] += seconds
+            request["bytes"] += num_bytes
+            request["retries"] += retries
+            request["latencies"].append(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        """
+        Return the metrics as a dict that can be written as JSON
+        """
+        with self.lock:
+            stages = {}
+            for name, stage in self.stages.items():
+                wall_seconds = stage["last_end"] - stage["first_start"]
+                stages[name] = {
+                    "calls": stage["calls"],
+                    "seconds": round(stage["seconds"], 3),
+                    "wall_seconds": round(wall_seconds, 3),
+                    "items": stage["items"],
+                    "items_per_second": round(stage["items"] / wall_seconds, 1) if stage["items"] and wall_seconds > 0 else None,
+                }
+            requests = {}
+            for key, request in self.requests.items():
+                requests[key] = dict((k, v) for k, v in request.items() if k != "latencies")
+                requests[key]["seconds"] = round(request["seconds"], 3)
+                for p in [50, 90, 99, 100]:
+                    value = percentile(request["latencies"], p)
+                    name = "latency_max_ms" if p == 100 else "latency_p%d_ms" % p
+                    requests[key][name] = round(value * 1000, 2) if value is not None else None
+            return {
+                "tool": self.tool,
+                "started": datetime.datetime.fromtimestamp(self.started).isoformat(),
+                "seconds": round(time.time() - self.started, 3),
+                "stages": stages,
+                "requests": requests,
+                "counters": dict(self.counters),
+            }
+
+    def write(self, metrics_filepath):
+        with open(metrics_filepath, "w") as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+# Metrics of the running tool, recorded to by the client, the query engine and the tools
+METRICS = Metrics()
+
+def stage(name):
+    return METRICS.stage(name)
+
+def count(name, n=1):
+    METRICS.count(name, n)
+
+def add_request(method, url, status, seconds, num_bytes=0, retries=0):
+    METRICS.add_request(method, url, status, seconds, num_bytes, retries)
+
+class ThreadProfiler(object):
+    """
+    cProfile for the main thread and every thread started while it is running, such as
+    the query engine's workers, merged into one set of stats
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles = [cProfile.Profile()]
+
+    def start_thread(self, frame, event, arg):
+        # Called once in each new thread through threading.setprofile, and replaced by the thread's own profile
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def start(self):
+        threading.setprofile(self.start_thread)
+        self.profiles[0].enable()
+
+    def stop(self, profile_filepath):
+        self.profiles[0].disable()
+        threading.setprofile(None)
+        with self.lock:
+            stats = pstats.Stats(*self.profiles)
+        stats.dump_stats(profile_filepath)
+        print "INFO: Wrote profile to %s. Functions with the most time spent in them:" % profile_filepath
+        stats.sort_stats("tottime").print_stats(15)
+
+class PyinstrumentProfiler(object):
+    """
+    Statistical profile of the main thread with pyinstrument, written as HTML
+    """
+
+    def __init__(self):
+        from pyinstrument import Profiler
+        self.profiler = Profiler()
+
+    def start(self):
+        self.profiler.start()
+
+    def stop(self, profile_filepath):
+        self.profiler.stop()
+        with open(profile_filepath, "w") as f:
+            f.write(self.profiler.output_html())
+        print "INFO: Wrote profile to %s" % profile_filepath
+        print self.profiler.output_text()
+
+# Metrics file and profiler of the running tool, set by start_from_args
+_run = {"metrics_file": None, "profile_file": None, "profiler": None}
+
+def add_metrics_arguments(parser):
+    """
+    Add arguments for metrics and profiling to an argparse parser
+    """
+    parser.add_argument("--metrics-file", help="Write the time spent in each stage and on each kind of API request, bytes transferred, retries and rates to this JSON file.", required=False)
+    parser.add_argument("--profile", help="Profile the run and write the profile to this file. cProfile profiles can be read with python -m pstats.", required=False)
+    parser.add_argument("--profiler", help="Profiler to use with --profile. pyinstrument writes HTML and only profiles the main thread. Default: cprofile", choices=PROFILERS, default="cprofile", required=False)
+
+def start_from_args(args):
+    """
+    Start profiling and set the metrics file from arguments added with add_metrics_arguments.
+    Call right after parsing arguments in a main function decorated with instrumented, so
+    threads started afterwards are profiled too.
+    """
+    if args.profile:
+        if args.profiler == "pyinstrument":
+            try:
+                profiler = PyinstrumentProfiler()
+            except ImportError:
+                print "ERROR: --profiler pyinstrument requires pyinstrument (pip install pyinstrument). Exiting."
+                sys.exit()
+        else:
+            profiler = ThreadProfiler()
+        _run["profile_file"] = args.profile
+        _run["profiler"] = profiler
+        profiler.start()
+    _run["metrics_file"] = args.metrics_file
+
+def finish():
+    """
+    Stop the profiler and write the profile and metrics file, if any
+    """
+    profiler, profile_file, metrics_file = _run["profiler"], _run["profile_file"], _run["metrics_file"]
+    _run.update({"metrics_file": None, "profile_file": None, "profiler": None})
+    if profiler is not None:
+        profiler.stop(profile_file)
+    if metrics_file:
+        METRICS.write(metrics_file)
+        print "INFO: Wrote metrics to %s" % metrics_file
+
+def instrumented(tool):
+    """
+    Decorator for the main function of a tool. Metrics are reset when it starts, and the
+    profile and metrics file set up with start_from_args are written when it returns or
+    exits, also through sys.exit.
+    """
+    def decorate(main):
+        @functools.wraps(main)
+        def wrapper(*args, **kwargs):
+            METRICS.reset(tool)
+            try:
+                return main(*args, **kwargs)
+            finally:
+                finish()
+        return wrapper
+    return decorate
@@ -0,0 +1,319 @@
+import sys
+import os
+import time
+import argparse
+import threading
+import Queue
+import requests
+import gdc_client
+import gdc_cache
+import gdc_engine
+import gdc_metrics
+import gdc_xml_parser
+import gdc_clinical2xml
+import gdc_specs2manifest
+from gdc_client import CASES_ENDPOINT, FILES_ENDPOINT
+
+def iter_queue(queue):
+    """
+    Yield items from a queue until a None sentinel is received
+    """
+    while True:
+        item = queue.get()
+        if item is None:
+            return
+        yield item
+
+class Pipeline(object):
+    """
+    Goes from a search (specs or a list of files) to a table of clinical data in one run.
+    The stages - search, case resolution, clinical file resolution, download and parse,
+    and write - run concurrently and are connected by bounded queues, so downstream stages
+    start on the first batch while upstream stages are still paging, and a slow stage
+    holds back the ones before it instead of letting work pile up in memory.
+    """
+
+    def __init__(self, client, engine, batch_size=500, shard_size=50, download_workers=4, queue_size=8):
+        self.client = client
+        self.engine = engine
+        self.batch_size = batch_size
+        self.shard_size = shard_size
+        self.download_workers = download_workers
+        self.cases = Queue.Queue(queue_size)  # Batches of case UUIDs
+        self.shards = Queue.Queue(queue_size)  # Shards of clinical file IDs
+        self.records = Queue.Queue(queue_size)  # Lists of parsed patient records
+        self.errors = []
+        self.num_cases = 0
+        self.num_clinical_files = 0
+        self.timings = {}
+
+    def error(self, message):
+        print "ERROR: %s" % message
+        self.errors.append(message)
+
+    def start_stage(self, name, target, *args):
+        """
+        Run a stage in a daemon thread, recording how long it was running
+        """
+        def run():
+            with gdc_metrics.stage(name) as stage:
+                try:
+                    target(*args)
+                finally:
+                    self.timings[name] = time.time() - stage.start
+        thread = threading.Thread(target=run, name=name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def emit_cases(self, case_ids):
+        """
+        Put new case UUIDs on the case queue in batches of batch_size, skipping duplicates,
+        and end the queue when case_ids is exhausted
+        """
+        seen = set()
+        batch = []
+        try:
+            for case_id in case_ids:
+                if case_id in seen:
+                    continue
+                seen.add(case_id)
+                batch.append(case_id)
+                if len(batch) == self.batch_size:
+                    self.cases.put(batch)
+                    batch = []
+            if batch:
+                self.cases.put(batch)
+        finally:
+            self.num_cases = len(seen)
+            self.cases.put(None)
+
+    def search_specs(self, filters, page_size, max_results=None):
+        """
+        Search stage: page through the files matching a search filter and emit their cases
+        """
+        params = {
+            "filters": filters,
+            "fields": "file_id,cases.case_id",
+            "format": "json",
+        }
+        def case_ids():
+            try:
+                for hits in self.engine.iter_pages(FILES_ENDPOINT, params, page_size, max_results):
+                    for hit in hits:
+                        for case in hit["cases"]:
+                            yield case["case_id"]
+            except requests.exceptions.RequestException as e:
+                self.error("Search failed, results are incomplete: %s" % e)
+        self.emit_cases(case_ids())
+
+    def query_file_cases(self, batch):
+        """
+        Return the case UUIDs for a batch of file names or UUIDs
+        """
+        field = "files.file_name" if batch[0].lower().endswith(".bam") else "files.file_id"
+        params = {
+            "filters": {"op":"in","content":{"field": field, "value": batch}},
+            "fields": "case_id",
+            "format": "json"
+        }
+        return [hit["case_id"] for hit in self.engine.query_all(CASES_ENDPOINT, params, len(batch))]
+
+    def search_files(self, input_files):
+        """
+        Search stage: resolve the cases of a list of file names or UUIDs, in concurrent batches
+        """
+        batches = [input_files[i:i + self.batch_size] for i in range(0, len(input_files), self.batch_size)]
+        def case_ids():
+            for batch, hits, error in self.engine.map_unordered(self.query_file_cases, batches):
+                if error is not None:
+                    self.error("Case lookup for a batch of %d files failed: %s" % (len(batch), error))
+                    continue
+                for case_id in hits:
+                    yield case_id
+        self.emit_cases(case_ids())
+
+    def query_clinical_files(self, batch):
+        """
+        Return the clinical file IDs of a batch of case UUIDs. Only the per-patient BCR XML
+        files are wanted: the BCR Biotab TXT files are project-wide and linked to every case
+        in a project, and other XML files are no patient records.
+        """
+        params = {
+            "filters": {
+                "op":"and",
+                "content": [
+                    {"op":"=","content":{"field": "data_category", "value": "Clinical"}},
+                    {"op":"=","content":{"field": "data_format", "value": "BCR XML"}},
+                    {"op":"in","content":{"field": "cases.case_id", "value": batch}},
+                ]
+            },
+            "fields": "file_id",
+            "format": "json"
+        }
+        return [hit["file_id"] for hit in self.engine.query_all(FILES_ENDPOINT, params, self.batch_size)]
+
+    def resolve_clinical(self):
+        """
+        Clinical stage: look up the clinical files of each batch of cases as it arrives, and
+        emit shards of clinical file IDs to download
+        """
+        seen = set()
+        shard = []
+        try:
+            for batch, file_ids, error in self.engine.map_unordered(self.query_clinical_files, iter_queue(self.cases)):
+                if error is not None:
+                    self.error("Clinical file lookup for a batch of %d cases failed: %s" % (len(batch), error))
+                    continue
+                for file_id in file_ids:
+                    if file_id in seen:
+                        continue
+                    seen.add(file_id)
+                    shard.append(file_id)
+                    if len(shard) == self.shard_size:
+                        self.shards.put(shard)
+                        shard = []
+            if shard:
+                self.shards.put(shard)
+        finally:
+            self.num_clinical_files = len(seen)
+            # One sentinel per download worker
+            for _ in range(self.download_workers):
+                self.shards.put(None)
+
+    def download(self):
+        """
+        Download stage: download and parse shards of clinical files, retrying shards whose download broke off,
+        and pass each record on as soon as it is parsed. Several of these run side by side.
+        """
+        try:
+            for shard in iter_queue(self.shards):
+                num_records = 0
+                try:
+                    for record in gdc_clinical2xml.iter_download_records(self.client, shard, self.engine.retries):
+                        self.records.put([record])
+                        num_records += 1
+                    print "INFO: Parsed %d of %d XML file(s) in shard" % (num_records, len(shard))
+                except gdc_clinical2xml.DOWNLOAD_ERRORS as e:
+                    self.error("Download of a shard of %d files failed: %s" % (len(shard), e))
+        finally:
+            self.records.put(None)
+
+    def iter_records(self):
+        """
+        Yield parsed patient records until every download worker is done
+        """
+        remaining = self.download_workers
+        while remaining > 0:
+            patient_records = self.records.get()
+            if patient_records is None:
+                remaining -= 1
+                continue
+            for record in patient_records:
+                yield record
+
+    def run(self, search, output_file, output_format="tsv", row_group_size=100000):
+        """
+        Start every stage, with search as the callable that runs the search stage, and write
+        the records to output_file as they arrive. Returns the number of patients written.
+        """
+        start = time.time()
+        self.start_stage("search", search)
+        self.start_stage("clinical", self.resolve_clinical)
+        for i in range(self.download_workers):
+            self.start_stage("download", self.download)
+
+        with gdc_metrics.stage("write") as stage:
+            num_records = gdc_xml_parser.write_records(self.iter_records(), output_file, output_format, row_group_size)
+            stage.add(num_records)
+        self.timings["write"] = time.time() - stage.start
+        self.engine.close()
+
+        print "INFO: %d case(s), %d clinical file(s), %d patient(s) in %.1f s" % (self.num_cases, self.num_clinical_files, num_records, time.time() - start)
+        for name in ["search", "clinical", "write"]:
+            print "INFO: Stage %s finished after %.1f s" % (name, self.timings.get(name, 0))
+        return num_records
+
+@gdc_metrics.instrumented("gdc_pipeline")
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Search the GDC and write a table of clinical data for the matching cases, in one run.")
+    parser.add_argument("--data-format", help="Data format of the files to search for, e.g. BAM. Repeat or comma-separate to match any of several.", action="append")
+    parser.add_argument("--experimental-strategy", help="Experimental strategy of the files to search for, e.g. RNA-Seq. Repeat or comma-separate to match any of several.", action="append")
+    parser.add_argument("--primary-site", help="Primary site of the files to search for, e.g. Colorectal. Repeat or comma-separate to match any of several.", action="append")
+    parser.add_argument("--filter-file", help="Path to a JSON or YAML file with a GDC filter expression to search with, combined with the other search arguments.")
+    parser.add_argument("--min-filesize", help="Minimum filesize in bytes. Default: 0", default="0")
+    parser.add_argument("--vital-status", help="Limit search to patients that are dead or alive.", choices=["dead", "alive"])
+    parser.add_argument("--num-results", help="Maximum number of files from the search, or 'all' for no limit. Default: all", default="all")
+    parser.add_argument("--page-size", help="Number of search results to fetch per request. Default: 100", type=int, default=100)
+    parser.add_argument("-f", "--from-file", help="Path to a file with file names or file UUIDs to start from instead of a search. One per line.")
+    parser.add_argument("-o", "--output-file", help="Path to output file. Missing directories will be created. Default: Current directory/tcga_clinical_data.tsv", default=os.path.join(os.getcwd(), "tcga_clinical_data.tsv"))
+    parser.add_argument("--format", help="Output format. Default: tsv", choices=gdc_xml_parser.OUTPUT_FORMATS, default="tsv")
+    parser.add_argument("--row-group-size", help="Number of patients per Parquet row group. Default: 100000", type=int, default=100000)
+    parser.add_argument("-b", "--batch-size", help="Number of files or cases to look up per API request. Default: 500", type=int, default=500)
+    parser.add_argument("-s", "--shard-size", help="Number of clinical files per download. Default: 50", type=int, default=50)
+    parser.add_argument("--download-workers", help="Number of shards to download and parse concurrently. Default: 4", type=int, default=4)
+    parser.add_argument("--queue-size", help="Number of batches each stage can get ahead of the next one. Default: 8", type=int, default=8)
+    gdc_client.add_client_arguments(parser)
+    gdc_cache.add_cache_arguments(parser)
+    gdc_cache.add_vocabulary_arguments(parser)
+    gdc_engine.add_engine_arguments(parser)
+    gdc_metrics.add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+    gdc_metrics.start_from_args(args)
+
+    specs = [args.data_format, args.experimental_strategy, args.primary_site]
+    if args.from_file and (any(specs) or args.filter_file):
+        print "ERROR: Provide either search specs or a file list, not both"
+        sys.exit()
+    if not args.from_file and not args.filter_file and not all(specs):
+        print "ERROR: --data-format, --experimental-strategy and --primary-site are all required when searching without --filter-file"
+        parser.print_help()
+        sys.exit()
+
+    client = gdc_client.client_from_args(args)
+    engine = gdc_engine.engine_from_args(args, client)
+    pipeline = Pipeline(client, engine, batch_size=args.batch_size, shard_size=args.shard_size,
+                        download_workers=args.download_workers, queue_size=args.queue_size)
+
+    if args.from_file:
+        if not os.path.isfile(args.from_file):
+            print "ERROR: Provided file (%s) does not seem to exist. Exiting" % args.from_file
+            sys.exit()
+        with open(args.from_file, "r") as f:
+            input_files = [line.strip() for line in f if line.strip()]
+        print "INFO: Looking up cases for %d file(s) from %s" % (len(input_files), args.from_file)
+        search = lambda: pipeline.search_files(input_files)
+    else:
+        spec_args = vars(args)
+        for arg in gdc_specs2manifest.SPEC_ARGS:
+            spec_args[arg] = gdc_specs2manifest.split_values(spec_args[arg])
+        if any(specs):
+            vocabulary = gdc_specs2manifest.load_vocabulary(client, gdc_cache.vocabulary_from_args(args), args.refresh, spec_args)
+            try:
+                gdc_specs2manifest.validate_specs(spec_args, vocabulary)
+            except gdc_specs2manifest.InvalidSpecError as e:
+                gdc_specs2manifest.report_invalid_spec(e)
+                sys.exit()
+        try:
+            filter_tree = gdc_specs2manifest.read_filter_file(args.filter_file) if args.filter_file else None
+        except ValueError as e:
+            print "ERROR: %s. Exiting." % e
+            sys.exit()
+        filters = gdc_specs2manifest.build_filters(spec_args, filter_tree=filter_tree)
+        max_results = None if args.num_results.lower() == "all" else int(args.num_results)
+        print "INFO: Searching for %s %s files from %s" % tuple(", ".join(spec_args[arg]) or "any" for arg in ["experimental_strategy", "data_format", "primary_site"])
+        search = lambda: pipeline.search_specs(filters, args.page_size, max_results)
+
+    # Create output directory if it doesn't exist
+    output_dir = os.path.dirname(os.path.abspath(args.output_file))
+    if not os.path.exists(output_dir):
+        print "Creating output directory %s" % output_dir
+        os.makedirs(output_dir)
+
+    num_records = pipeline.run(search, args.output_file, args.format, args.row_group_size)
+    print "INFO: Wrote %d patients to %s" % (num_records, args.output_file)
+    if pipeline.errors:
+        print "ERROR: %d error(s) during the run, output is incomplete" % len(pipeline.errors)
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,19 @@ import json
 import argparse
 import sys
 import os
+import difflib
+import threading
+import Queue
 import requests
+import gdc_client
+import gdc_cache
+import gdc_engine
+import gdc_exclude
+import gdc_download_index
+import gdc_metrics
+from gdc_client import FILES_ENDPOINT, MANIFEST_ENDPOINT
 
-# TODO: Create CHOICES for arguments
+# Built-in choices, used when the valid values can't be fetched from the API
 choices = {
     "primary_site": [
         "Kidney",
@@ -60,10 +70,227 @@ choices = {
     ]
 }
 
-CASES_ENDPOINT = "https://gdc-api.nci.nih.gov/cases"
-DATA_ENDPOINT = "https://gdc-api.nci.nih.gov/data"
-FILES_ENDPOINT = "https://gdc-api.nci.nih.gov/files"
-MANIFEST_ENDPOINT = "https://gdc-api.nci.nih.gov/manifest"
+# Search arguments with values from a fixed vocabulary, which can have several values each
+SPEC_ARGS = ["primary_site", "experimental_strategy", "data_format"]
+
+# Search arguments that are validated against the API's vocabulary, and the facets of the files endpoint with their values
+VOCABULARY_FACETS = {
+    "primary_site": "cases.project.primary_site",
+    "experimental_strategy": "experimental_strategy",
+    "data_format": "data_format",
+}
+
+def fetch_vocabulary(client):
+    """
+    Fetch the valid values of the arguments in VOCABULARY_FACETS from the facets of the
+    files endpoint. Returns a dictionary with key/value argument/sorted list of values.
+    """
+    params = {
+        "facets": ",".join(sorted(VOCABULARY_FACETS.values())),
+        "size": 0,
+        "format": "json",
+    }
+    r = client.post_json(FILES_ENDPOINT, params)
+    if r.status_code != 200:
+        raise requests.exceptions.HTTPError("HTTP status code %s. Server says:\n%s" % (r.status_code, r.text), response=r)
+    aggregations = r.json()["data"]["aggregations"]
+    values = {}
+    for arg, facet in VOCABULARY_FACETS.items():
+        # Files without a value are counted in a _missing bucket
+        values[arg] = sorted(bucket["key"] for bucket in aggregations[facet]["buckets"] if bucket["key"] != "_missing")
+    return values
+
+# Operators of GDC filters that combine other filters, and those that test a field
+GROUP_OPS = ["and", "or"]
+FIELD_OPS = ["=", "!=", "<", "<=", ">", ">=", "in", "exclude", "is", "not"]
+
+def split_values(values):
+    """
+    Return the values of a search argument that can be repeated and comma-separated as a
+    flat list without duplicates, e.g. ["BAM,VCF", "BAM"] becomes ["BAM", "VCF"]. A single
+    string is accepted too. Returns an empty list if the argument is not set.
+    """
+    if not values:
+        return []
+    if isinstance(values, basestring):
+        values = [values]
+    result = []
+    for value in values:
+        for v in value.split(","):
+            v = v.strip()
+            if v and v not in result:
+                result.append(v)
+    return result
+
+def value_filter(field, values):
+    """
+    Return a filter matching any of values in field. A single value is an = filter.
+    """
+    if len(values) == 1:
+        return {"op":"=","content":{"field": field, "value": values[0]}}
+    return {"op":"in","content":{"field": field, "value": values}}
+
+def check_filter(tree, path="filter"):
+    """
+    Check that tree is a GDC filter expression, with and/or groups of field filters.
+    Raises ValueError naming the offending part if not.
+    """
+    if not isinstance(tree, dict) or "op" not in tree or "content" not in tree:
+        raise ValueError("%s must be an object with 'op' and 'content'" % path)
+    op = tree["op"]
+    if op in GROUP_OPS:
+        if not isinstance(tree["content"], list) or len(tree["content"]) == 0:
+            raise ValueError("%s: content of '%s' must be a non-empty list of filters" % (path, op))
+        for i, child in enumerate(tree["content"]):
+            check_filter(child, "%s.content[%d]" % (path, i))
+    elif op in FIELD_OPS:
+        content = tree["content"]
+        if not isinstance(content, dict) or "field" not in content or "value" not in content:
+            raise ValueError("%s: content of '%s' must be an object with 'field' and 'value'" % (path, op))
+    else:
+        raise ValueError("%s: unknown op '%s', must be one of %s" % (path, op, ", ".join(GROUP_OPS + FIELD_OPS)))
+
+def read_filter_file(filter_file):
+    """
+    Read a GDC filter expression from a JSON or YAML (.yaml/.yml, requires PyYAML) file.
+    Raises ValueError if it can't be read or isn't a valid filter.
+    """
+    if not os.path.isfile(filter_file):
+        raise ValueError("Provided filter file (%s) does not seem to exist" % filter_file)
+    yaml_file = filter_file.lower().endswith((".yaml", ".yml"))
+    if yaml_file:
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("Reading YAML filter files requires PyYAML (pip install pyyaml)")
+    try:
+        with open(filter_file, "r") as f:
+            tree = yaml.safe_load(f) if yaml_file else json.load(f)
+        check_filter(tree)
+    except Exception as e:
+        raise ValueError("Could not read filter from %s: %s" % (filter_file, e))
+    return tree
+
+def invalid_specs(args, vocabulary):
+    """
+    Return the arguments in VOCABULARY_FACETS with a value that is not in vocabulary
+    """
+    return [arg for arg in sorted(VOCABULARY_FACETS) if any(value not in vocabulary.get(arg, []) for value in split_values(args[arg]))]
+
+def load_vocabulary(client, vocabulary_cache=None, refresh=False, args=None):
+    """
+    Return the valid values of the search arguments. Cached values are used while they are
+    fresh, unless refresh is set or a value in args is not among them, since it may have
+    been added since. Otherwise they are fetched from the API and cached. If the API can't
+    be reached, stale cached values are used, or the built-in choices as a last resort.
+    """
+    cached, fresh = None, False
+    if vocabulary_cache is not None:
+        cached, fresh = vocabulary_cache.load()
+        if fresh and not refresh:
+            if args is None or not invalid_specs(args, cached):
+                return cached
+            print "INFO: Unknown search values, fetching valid values from the API in case they are new"
+
+    try:
+        values = fetch_vocabulary(client)
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        if cached is not None:
+            print "WARNING: Could not fetch valid search values from the API, using cached values (%s)" % e
+            return cached
+        print "WARNING: Could not fetch valid search values from the API, using built-in values (%s)" % e
+        return choices
+
+    if vocabulary_cache is not None:
+        vocabulary_cache.save(values)
+    return values
+
+def suggest(value, values):
+    """
+    Return the values closest to a misspelled value, best match first
+    """
+    lowered = dict((v.lower(), v) for v in values)
+    if value.lower() in lowered:
+        return [lowered[value.lower()]]
+    return [lowered[match] for match in difflib.get_close_matches(value.lower(), lowered.keys(), n=3, cutoff=0.6)]
+
+def iter_file_hits(engine, filters, fields, page_size, max_results=None):
+    """
+    Page through the files endpoint using from/size and yield hits one at a time, in
+    order. Pages after the first are fetched concurrently by the query engine, a few
+    pages ahead of the one being yielded, so only those pages are held in memory
+    regardless of the total number of results. Stops after max_results hits if set.
+    Raises requests.exceptions.RequestException if a page can't be fetched.
+    """
+    params = {
+        "filters": filters,
+        "fields": fields,
+        "format": "json",
+    }
+    for hits in engine.iter_pages(FILES_ENDPOINT, params, page_size, max_results):
+        for hit in hits:
+            yield hit
+
+class ManifestWriter(threading.Thread):
+    """
+    Background thread that fetches manifests for chunks of file IDs while the
+    search is still paging, and appends them to the output file as they arrive.
+    Only the header of the first chunk is written.
+    """
+
+    def __init__(self, client, output_file, max_pending=4):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.client = client
+        self.output_file = output_file
+        self.chunks = Queue.Queue(max_pending)
+        self.out = None
+        self.num_written = 0
+        self.error = None
+
+    def add_chunk(self, file_ids):
+        self.chunks.put(file_ids)
+
+    def finish(self):
+        self.chunks.put(None)
+        self.join()
+        if self.out:
+            self.out.close()
+
+    def fetch_chunk(self, file_ids):
+        manifest_params = {"ids": file_ids}
+        with gdc_metrics.stage("manifest") as stage:
+            rr = self.client.post_json(MANIFEST_ENDPOINT, manifest_params)
+            stage.add(len(file_ids))
+        if not rr.status_code == 200:
+            self.error = rr.text
+            return
+
+        lines = rr.content.splitlines(True)
+        if self.out is None:
+            self.out = open(self.output_file, "wb")
+        else:
+            # Header has already been written
+            lines = lines[1:]
+        for line in lines:
+            if not line.endswith("\n"):
+                line += "\n"
+            self.out.write(line)
+        self.out.flush()
+        self.num_written += len(file_ids)
+        print "INFO: Wrote manifest for %d files" % self.num_written
+
+    def run(self):
+        while True:
+            file_ids = self.chunks.get()
+            if file_ids is None:
+                return
+            # Keep draining the queue after an error, so the producer never blocks
+            if self.error is None:
+                try:
+                    self.fetch_chunk(file_ids)
+                except requests.exceptions.RequestException as e:
+                    self.error = str(e)
 
 class MyParser(argparse.ArgumentParser):
 
@@ -75,22 +302,31 @@ class MyParser(argparse.ArgumentParser):
     def print_help(self):
         print ""
         print "USAGE: python %s --data-format <FORMAT> --experimental-strategy <STRATEGY> --primary-site <SITE> " % (sys.argv[0])
+        print "   or: python %s --filter-file <FILTER_FILE> [--data-format <FORMAT> ...]" % (sys.argv[0])
         print ""
-        print "REQUIRED ARGUMENTS"
+        print "REQUIRED ARGUMENTS (unless --filter-file is given)"
         print "--data-format"
         print "     The data format you're looking for. Must match"
         print "     one of the options printed under 'data-format'"
-        print "     below. E.g. BAM"
+        print "     below. E.g. BAM. Several formats can be given"
+        print "     comma-separated or by repeating the argument,"
+        print "     and files with any of them are included."
         print "--experimental-strategy"
         print "     The experimental strategy you're looking for."
         print "     Must match one of the options printed under "
         print "     'experimental-strategy' below. E.g. RNA-Seq"
+        print "     Can have several values, like --data-format."
         print "--primary-site"
         print "     The primary site you're looking for. Must"
         print "     match one of the options printed under"
         print "     'primary-site' below. E.g. Colorectal"
+        print "     Can have several values, like --data-format."
         print ""
         print "OPTIONAL ARGUMENTS"
+        print "--filter-file"
+        print "     Path to a JSON or YAML file with a GDC filter"
+        print "     expression, combined with the other search"
+        print "     arguments. YAML requires PyYAML."
         print "--min-filesize"
         print "     The minimum size of resulting files, in bytes."
         print "     E.g. 5000000000 (for 5GB). Default: 0"
@@ -100,14 +336,92 @@ class MyParser(argparse.ArgumentParser):
         print "     downloaded, and don't want to download again."
         print "     Must either be a list of comma-separated file"
         print "     names, or path to a TXT-file containing one"
-        print "     file name per line."
+        print "     file name per line. Files are skipped while"
+        print "     paging through the search results."
+        print "--exclude-from"
+        print "     Exclude the files in a manifest, a TXT-file with"
+        print "     one file name or UUID per line, or a download"
+        print "     directory, matched by UUID, name or md5. Can be"
+        print "     repeated."
+        print "--exclude-index"
+        print "     Path to an index file of files to exclude, for"
+        print "     large archives. Built from --exclude-from if"
+        print "     given, otherwise an index built before is used."
+        print "--download-root"
+        print "     Directory with downloaded files. It is scanned"
+        print "     into the download index, hashing only new and"
+        print "     changed files, and files that are already"
+        print "     downloaded with the right md5 are left out. Can"
+        print "     be repeated."
+        print "--skip-downloaded"
+        print "     Leave out files that are in the download index"
+        print "     with the right md5, without scanning first."
+        print "--download-index"
+        print "     Path to the download index. Default:"
+        print "     ~/.gdc-tools/downloads.sqlite"
+        print "--hash-jobs"
+        print "     Number of files to hash in parallel when"
+        print "     scanning. Default: 4"
         print "--num-results"
-        print "     Limit the number of results. Default: 100"
+        print "     Limit the number of results. Use 'all' to fetch"
+        print "     every matching file. Default: 100"
+        print "--page-size"
+        print "     Number of results to fetch per request when"
+        print "     paging through the search results. Default: 100"
+        print "--manifest-chunk-size"
+        print "     Number of file IDs to request a manifest for at"
+        print "     a time. Manifest chunks are fetched while the"
+        print "     search is still running. Default: 500"
+        print "--workers"
+        print "     Number of search result pages to fetch"
+        print "     concurrently. Default: %d" % gdc_engine.DEFAULT_WORKERS
+        print "--retries"
+        print "     Number of times to retry a query whose"
+        print "     response broke off while it was read."
+        print "     Connection errors, 429 and 5xx are retried"
+        print "     with --http-retries."
+        print "     Default: %d" % gdc_engine.DEFAULT_RETRIES
+        print "--rate-limit"
+        print "     Maximum number of API requests per second, 0"
+        print "     for no limit. Default: %d" % gdc_engine.DEFAULT_RATE_LIMIT
         print "--output-file"
         print "     File to write manifest to. Default: current"
         print "     directory/manifest.tsv. Directories will be"
         print "     created and existing files will be over-"
         print "     written."
+        print "--pool-size"
+        print "     Number of pooled HTTP connections to the API."
+        print "     Default: %d" % gdc_client.DEFAULT_POOL_SIZE
+        print "--timeout"
+        print "     Seconds to wait for the API before giving up"
+        print "     on a request. Default: %d" % gdc_client.DEFAULT_TIMEOUT
+        print "--http-retries"
+        print "     Number of times to retry a request that fails"
+        print "     with a connection error, 429 or 5xx."
+        print "     Default: %d" % gdc_client.DEFAULT_HTTP_RETRIES
+        print "--no-cache"
+        print "     Don't read or write the local response cache"
+        print "     or vocabulary."
+        print "--refresh"
+        print "     Query the API even for cached responses and"
+        print "     valid search values, and update the cache with"
+        print "     the new responses."
+        print "--cache-file"
+        print "     Path to the response cache."
+        print "     Default: %s" % gdc_cache.DEFAULT_CACHE_FILE
+        print "--cache-ttl"
+        print "     Hours before a cached response expires."
+        print "     Default: %d" % gdc_cache.DEFAULT_TTL_HOURS
+        print "--cache-max-size"
+        print "     Maximum size of the response cache in MB. Least"
+        print "     recently used responses are evicted first."
+        print "     Default: %d" % gdc_cache.DEFAULT_MAX_SIZE_MB
+        print "--vocabulary-file"
+        print "     Path to the cached list of valid search values."
+        print "     Default: %s" % gdc_cache.DEFAULT_VOCABULARY_FILE
+        print "--vocabulary-ttl"
+        print "     Hours before the valid search values are"
+        print "     fetched again. Default: %d" % gdc_cache.DEFAULT_VOCABULARY_TTL_HOURS
         print "--vital-status"
         print "     Patient vital status. Choices: 'dead' or 'alive'."
         print "     If not set, results include both."
@@ -115,60 +429,66 @@ class MyParser(argparse.ArgumentParser):
         print "     Minimum number of days from diagnosis to death."
         print "--days-to-death-max"
         print "     Maximum number of days from diagnosis to death"
-        print "SUPPORTED CHOICES:"
+        print "--metrics-file"
+        print "     Write the time spent in each stage and on each"
+        print "     kind of API request, bytes transferred, retries"
+        print "     and rates to this JSON file."
+        print "--profile"
+        print "     Profile the run and write the profile to this"
+        print "     file."
+        print "--profiler"
+        print "     Profiler to use with --profile: cprofile or"
+        print "     pyinstrument. Default: cprofile"
+        print "SUPPORTED CHOICES (built-in, the valid values are fetched from the API when running):"
         for term in sorted(choices.keys()):
             print "--%s:" % term.replace("_", "-")
             for value in sorted(choices[term]):
                 print "\t%s" % value
 
-# Handle arguments
-parser = MyParser()
-parser.add_argument("--data-format", help="Expected data format, e.g. BAM", required=True)
-parser.add_argument("--experimental-strategy", help="E.g. RNA-Seq", required=True)
-parser.add_argument("--primary-site", help="E.g. Colorectal", required=True)
-parser.add_argument("--min-filesize", help="Minimum filesize in bytes. E.g. 5000000000 for 5GB. Default: 0", default="0", required=False)
-parser.add_argument("--exclude-files", help="A list of file names to exclude from manifest, e.g. if they meet the search criteria, but are already downloaded. Comma-separated list of file names or path to a TXT-file containing one filename per line", required=False)
-parser.add_argument("--num-results", help="Maximum number of results. Default: 100", default="100")
-parser.add_argument("--output-file", help="File to write manifest to. Default: Current directory/manifest.tsv", default=os.path.join(os.getcwd(), "manifest.tsv"))
-parser.add_argument("--vital-status", help="Limit search to a certani vital status of patient. Dead or alive. If not set, results include both.", choices=["dead", "alive"], required=False)
-parser.add_argument("--days-to-death-min", help="Minimum days to death.", required=False)
-parser.add_argument("--days-to-death-max", help="Maximum days to death.", required=False)
-args = vars(parser.parse_args())
-
-# Print arguments to user
-print "INFO: Provided arguments:"
-for key, value in args.items():
-    print "%s --> %s" % (key, value)
-
-# Valdate primary site
-if args["primary_site"] not in choices["primary_site"]:
-    print "ERROR: Malformed argument for 'primary-site'. Please make sure it exactly matches one of these:"
-    for ps in sorted(choices["primary_site"]):
-        print ps
-    print "ERROR: Input provided: %s" % args["primary_site"]
-    sys.exit()
-
-# Validate experimental strategy
-if args["experimental_strategy"] not in choices["experimental_strategy"]:
-    print "ERROR: Mailformed argument for 'experimental-strategy'. Please make sure it exactly matches one of these:"
-    for es in sorted(choices["experimental_strategy"]):
-        print es
-    print "ERROR: Input provided: %s" % args["experimental_strategy"]
-    sys.exit()
-
-# Validate data format
-if args["data_format"] not in choices["data_format"]:
-    print "ERROR: Mailformed argument for 'data-format'. Please make sure it exactly matches one of these:"
-    for df in sorted(choices["data_format"]):
-        print df
-    print "ERROR: Input provided: %s" % args["data_format"]
-    sys.exit()
-
-# Get files to exclude from args
-exclude_files = args.pop("exclude_files")
-
-# Handle excluded files
-if exclude_files:
+class InvalidSpecError(ValueError):
+    """
+    Raised by validate_specs for a search value that is not among the valid values, with
+    the valid values and the closest matches to it
+    """
+
+    def __init__(self, arg, value, valid_values):
+        self.arg = arg
+        self.value = value
+        self.valid_values = sorted(valid_values)
+        self.matches = suggest(value, valid_values)
+        message = "Invalid value for '%s': %s" % (arg.replace("_", "-"), value)
+        if self.matches:
+            message += ". Did you mean %s?" % " or ".join("'%s'" % match for match in self.matches)
+        ValueError.__init__(self, message)
+
+def validate_specs(args, vocabulary=None):
+    """
+    Check that primary site, experimental strategy and data format are among the valid
+    values in vocabulary (by default the built-in choices). Raises InvalidSpecError for
+    the first value that isn't.
+    """
+    vocabulary = vocabulary or choices
+    for arg in SPEC_ARGS:
+        for value in split_values(args.get(arg)):
+            if value not in vocabulary[arg]:
+                raise InvalidSpecError(arg, value, vocabulary[arg])
+
+def report_invalid_spec(e):
+    """
+    Print an InvalidSpecError with the valid values and the closest matches
+    """
+    print "ERROR: Malformed argument for '%s'. Please make sure it exactly matches one of these:" % e.arg.replace("_", "-")
+    for valid_value in e.valid_values:
+        print valid_value
+    print "ERROR: Input provided: %s" % e.value
+    if e.matches:
+        print "ERROR: Did you mean %s?" % " or ".join("'%s'" % match for match in e.matches)
+
+def read_exclude_files(exclude_files):
+    """
+    Return the list of file names to exclude, from either a TXT-file with one file name
+    per line or a comma-separated list of file names
+    """
     # Check if it's an existing .txt-file
     if os.path.exists(exclude_files):
         if exclude_files.lower().endswith(".txt"):
@@ -182,97 +502,256 @@ if exclude_files:
     # Feedback to user
     for f in exclude_files:
         print "Excluding file %s" % f
+    return exclude_files
 
+def build_filters(args, exclude_files=None, filter_tree=None):
+    """
+    Create the search filter for the files endpoint from a dictionary of arguments, and
+    optionally a filter expression that is combined with the arguments with and.
+    Arguments with several values match any of them, and arguments that are missing or
+    None are not filtered on.
+    """
+    # Create filter based on input arguments
+    filters = {
+        "op":"and",
+        "content": []
+    }
+    # Filter on data format, experimental strategy and primary site
+    for arg, field in [("data_format", "data_format"), ("experimental_strategy", "experimental_strategy"), ("primary_site", "cases.project.primary_site")]:
+        values = split_values(args.get(arg))
+        if values:
+            filters["content"].append(value_filter(field, values))
+    # Filter on minimum file size
+    filters["content"].append({"op":">","content":{"field": "file_size", "value":args.get("min_filesize") or "0"}})
 
-# Create filter based on input arguments
-filters = {
-    "op":"and",
-    "content": [
-        # Filter on data format
-        {"op":"=","content":{"field": "data_format","value": args["data_format"]}},
-        # Filter on experimental strategy
-        {"op":"=","content":{"field": "experimental_strategy", "value": args["experimental_strategy"]}},
-        # Filter on primary site
-        {"op":"=","content":{"field": "cases.project.primary_site", "value": args["primary_site"]}},
-        # Filter on minimum file size
-        {"op":">","content":{"field": "file_size", "value":args["min_filesize"]}},
-    ]
-}
-# Exclude certain filenames if specified
-if exclude_files:
-    exclude_filter = {"op":"exclude","content":{"field": "file_name", "value":exclude_files}}
-    filters["content"].append(exclude_filter)
-
-# Filter on vital status, if specified
-if args["vital_status"]:
-    vital_filter = {"op":"=","content":{"field": "cases.diagnoses.vital_status", "value": args["vital_status"]}}
-    # vital_filter = {"op":"=","content":{"field": "cases.diagnoses.vital_status", "value": args["vital_status"]}}
-    filters["content"].append(vital_filter)
-
-# Filter on days to death, if specified
-# if args["days_to_death_min"] and args["days_to_death_max"]:
-    # dod_both_filter = {"op":"and", "content":[
-        # {"op":"<=", "content":{"field": "cases.diagnoses.days_to_death", "value":[args["days_to_death_min"]]}},
-        # {"op":">=", "content":{"field": "cases.diagnoses.days_to_death", "value":[args["days_to_death_max"]]}}
-    # ]}
-    # filters["content"].append(dod_both_filter)
-if args["days_to_death_min"]:
-    dod_min_filter = {"op":">=", "content":{"field": "cases.diagnoses.days_to_death", "value":[args["days_to_death_min"]]}}
-    filters["content"].append(dod_min_filter)
-if args["days_to_death_max"]:
-    dod_max_filter = {"op":"<=", "content":{"field": "cases.diagnoses.days_to_death", "value":[args["days_to_death_max"]]}}
-    filters["content"].append(dod_max_filter)
-
-# print json.dumps(filters, indent=4)
-
-# Perform GET request
-params = {
-    "filters": json.dumps(filters),
-    # "fields": "data_category,data_format,data_type,experimental_strategy,file_size,file_name,file_id,file_state,cases.project.disease_type,cases.project.primary_site",
-    "fields": "file_id,file_name",
-    "format": "json",
-    "pretty": "true",
-    "size": args["num_results"],
-}
+    # Add the filter expression from a filter file, if any
+    if filter_tree:
+        filters["content"].append(filter_tree)
+    # Exclude certain filenames if specified
+    if exclude_files:
+        exclude_filter = {"op":"exclude","content":{"field": "file_name", "value":exclude_files}}
+        filters["content"].append(exclude_filter)
+
+    # Filter on vital status, if specified
+    if args.get("vital_status"):
+        vital_filter = {"op":"=","content":{"field": "cases.diagnoses.vital_status", "value": args["vital_status"]}}
+        # vital_filter = {"op":"=","content":{"field": "cases.diagnoses.vital_status", "value": args["vital_status"]}}
+        filters["content"].append(vital_filter)
+
+    # Filter on days to death, if specified
+    # if args["days_to_death_min"] and args["days_to_death_max"]:
+        # dod_both_filter = {"op":"and", "content":[
+            # {"op":"<=", "content":{"field": "cases.diagnoses.days_to_death", "value":[args["days_to_death_min"]]}},
+            # {"op":">=", "content":{"field": "cases.diagnoses.days_to_death", "value":[args["days_to_death_max"]]}}
+        # ]}
+        # filters["content"].append(dod_both_filter)
+    if args.get("days_to_death_min"):
+        dod_min_filter = {"op":">=", "content":{"field": "cases.diagnoses.days_to_death", "value":[args["days_to_death_min"]]}}
+        filters["content"].append(dod_min_filter)
+    if args.get("days_to_death_max"):
+        dod_max_filter = {"op":"<=", "content":{"field": "cases.diagnoses.days_to_death", "value":[args["days_to_death_max"]]}}
+        filters["content"].append(dod_max_filter)
+    return filters
+
+class ManifestError(Exception):
+    """
+    Raised by write_manifest when the file list or a manifest chunk can't be downloaded.
+    The manifest for the first num_written files has been written, but it is incomplete.
+    """
+
+    def __init__(self, search_error, manifest_error, num_written):
+        self.search_error = search_error
+        self.manifest_error = manifest_error
+        self.num_written = num_written
+        Exception.__init__(self, "; ".join(str(error) for error in (search_error, manifest_error) if error is not None))
+
+def write_manifest(client, engine, filters, output_file, max_results=None, page_size=100, chunk_size=500, excludes=(), download_index=None):
+    """
+    Search for the files matching filters and write their manifest to output_file,
+    creating its directory if needed. Manifests are downloaded and written in chunks
+    while the search is still paging. Files matching one of excludes, and files in
+    download_index with the md5 the GDC has for them, are skipped. Returns a dict with
+    the number of files in the manifest and of duplicate, excluded and already
+    downloaded files skipped. Raises ManifestError if the search or a manifest chunk
+    fails. The engine, excludes and download index are left open.
+    """
+    # Create output directory if it doesn't exist
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    try:
+        os.makedirs(output_dir)
+    except OSError:
+        if not os.path.isdir(output_dir):
+            raise
+
+    downloaded_md5s = download_index.md5s() if download_index is not None else set()
+
+    # Page through the search results and hand file IDs to the manifest writer in chunks,
+    # so manifests are downloaded and written while the search is still paging.
+    # fields = "data_category,data_format,data_type,experimental_strategy,file_size,file_name,file_id,file_state,cases.project.disease_type,cases.project.primary_site"
+    print "INFO: Downloading file list and manifest"
+    writer = ManifestWriter(client, output_file)
+    writer.start()
+    counts = {"files": 0, "duplicates": 0, "excluded": 0, "downloaded": 0}
+    chunk = []
+    seen = set()  # File IDs already in the manifest
+    # Excluded and downloaded files don't count towards the number of results, so page until there are enough
+    skipping = bool(excludes) or download_index is not None
+    fields = "file_id,file_name,md5sum" if skipping else "file_id,file_name"
+    search_limit = None if skipping else max_results
+    search_error = None
+    print "INFO: File list:"
+    with gdc_metrics.stage("search") as stage:
+        try:
+            for hit in iter_file_hits(engine, filters, fields, page_size, search_limit):
+                # No use paging on if the manifest can't be written
+                if writer.error is not None:
+                    break
+                # Pages can overlap if the results change while paging
+                if hit["file_id"] in seen:
+                    counts["duplicates"] += 1
+                    continue
+                seen.add(hit["file_id"])
+                if gdc_exclude.is_excluded(excludes, hit):
+                    counts["excluded"] += 1
+                    continue
+                if download_index is not None:
+                    if hit.get("md5sum") in downloaded_md5s:
+                        counts["downloaded"] += 1
+                        continue
+                    for path, size, md5 in download_index.lookup(hit["file_id"]):
+                        print "WARNING: %s is downloaded to %s, but its md5 is %s instead of %s. Downloading it again." % (hit["file_id"], path, md5, hit.get("md5sum"))
+                print "%s --> %s" % (hit["file_id"], hit["file_name"])
+                chunk.append(hit["file_id"])
+                counts["files"] += 1
+                if len(chunk) == chunk_size:
+                    writer.add_chunk(chunk)
+                    chunk = []
+                if max_results is not None and counts["files"] >= max_results:
+                    break
+        except requests.exceptions.RequestException as e:
+            search_error = str(e)
+        stage.add(counts["files"])
+    if chunk:
+        writer.add_chunk(chunk)
+    writer.finish()
+
+    if search_error is not None or writer.error is not None:
+        raise ManifestError(search_error, writer.error, writer.num_written)
+    return counts
+
+@gdc_metrics.instrumented("gdc_specs2manifest")
+def main(argv=None):
+    # Handle arguments
+    parser = MyParser()
+    parser.add_argument("--data-format", help="Expected data format, e.g. BAM. Repeat or comma-separate to match any of several.", action="append", required=False)
+    parser.add_argument("--experimental-strategy", help="E.g. RNA-Seq. Repeat or comma-separate to match any of several.", action="append", required=False)
+    parser.add_argument("--primary-site", help="E.g. Colorectal. Repeat or comma-separate to match any of several.", action="append", required=False)
+    parser.add_argument("--filter-file", help="Path to a JSON or YAML file with a GDC filter expression, combined with the other search arguments.", required=False)
+    parser.add_argument("--min-filesize", help="Minimum filesize in bytes. E.g. 5000000000 for 5GB. Default: 0", default="0", required=False)
+    parser.add_argument("--exclude-files", help="A list of file names to exclude from manifest, e.g. if they meet the search criteria, but are already downloaded. Comma-separated list of file names or path to a TXT-file containing one filename per line", required=False)
+    parser.add_argument("--num-results", help="Maximum number of results, or 'all' for no limit. Default: 100", default="100")
+    parser.add_argument("--page-size", help="Number of results to fetch per request. Default: 100", default="100")
+    parser.add_argument("--manifest-chunk-size", help="Number of file IDs per manifest request. Default: 500", default="500")
+    parser.add_argument("--output-file", help="File to write manifest to. Default: Current directory/manifest.tsv", default=os.path.join(os.getcwd(), "manifest.tsv"))
+    parser.add_argument("--vital-status", help="Limit search to a certani vital status of patient. Dead or alive. If not set, results include both.", choices=["dead", "alive"], required=False)
+    parser.add_argument("--days-to-death-min", help="Minimum days to death.", required=False)
+    parser.add_argument("--days-to-death-max", help="Maximum days to death.", required=False)
+    gdc_client.add_client_arguments(parser)
+    gdc_cache.add_cache_arguments(parser)
+    gdc_cache.add_vocabulary_arguments(parser)
+    gdc_exclude.add_exclude_arguments(parser)
+    gdc_download_index.add_download_index_arguments(parser)
+    gdc_engine.add_engine_arguments(parser)
+    gdc_metrics.add_metrics_arguments(parser)
+    parsed_args = parser.parse_args(argv)
+    gdc_metrics.start_from_args(parsed_args)
+    args = vars(parsed_args)
+    client = gdc_client.client_from_args(parsed_args)
+    engine = gdc_engine.engine_from_args(parsed_args, client)
+
+    # Print arguments to user
+    print "INFO: Provided arguments:"
+    for key, value in args.items():
+        print "%s --> %s" % (key, value)
+
+    # Search values are required, unless a filter file says what to search for
+    for arg in SPEC_ARGS:
+        args[arg] = split_values(args[arg])
+    filter_file = args.pop("filter_file")
+    if not filter_file and not all(args[arg] for arg in SPEC_ARGS):
+        parser.error("--data-format, --experimental-strategy and --primary-site are required without --filter-file")
+    try:
+        filter_tree = read_filter_file(filter_file) if filter_file else None
+    except ValueError as e:
+        print "ERROR: %s. Exiting." % e
+        sys.exit()
+
+    # Validate search values against the valid values in the GDC
+    if any(args[arg] for arg in SPEC_ARGS):
+        vocabulary = load_vocabulary(client, gdc_cache.vocabulary_from_args(parsed_args), parsed_args.refresh, args)
+        try:
+            validate_specs(args, vocabulary)
+        except InvalidSpecError as e:
+            report_invalid_spec(e)
+            sys.exit()
+
+    # Get files to exclude from args. They are skipped while paging instead of being sent
+    # to the API, which would make every search query as big as the list of files.
+    excludes = []
+    exclude = gdc_exclude.exclude_from_args(parsed_args)
+    if exclude is not None:
+        excludes.append(exclude)
+    exclude_files = args.pop("exclude_files")
+    if exclude_files:
+        excludes.append(gdc_exclude.ExcludeSet(read_exclude_files(exclude_files)))
+    if excludes:
+        print "INFO: Excluding files matching %d file UUID(s), name(s) or md5 sum(s)" % sum(len(exclude) for exclude in excludes)
+
+    # Files that are already downloaded, with the md5 the GDC has for them, are left out.
+    # A download with another md5 is broken or partial, so it is downloaded again.
+    download_index = gdc_download_index.download_index_from_args(parsed_args)
+
+    filters = build_filters(args, filter_tree=filter_tree)
+
+    # Parse result limits
+    if args["num_results"].lower() == "all":
+        max_results = None
+    else:
+        max_results = int(args["num_results"])
+
+    try:
+        counts = write_manifest(client, engine, filters, args["output_file"], max_results=max_results, page_size=int(args["page_size"]), chunk_size=int(args["manifest_chunk_size"]), excludes=excludes, download_index=download_index)
+    except ManifestError as e:
+        if e.search_error is not None:
+            print "ERROR: Something went wrong when downloading file list:"
+            print e.search_error
+        if e.manifest_error is not None:
+            print "ERROR: Something went wrong when downloading manifest. Server says:"
+            print e.manifest_error
+        if e.num_written > 0:
+            print "ERROR: Manifest for the first %d files was written to %s, but it is incomplete" % (e.num_written, args["output_file"])
+        sys.exit()
+    except OSError as e:
+        print "ERROR: Could not create output directory: %s" % e
+        sys.exit()
+    finally:
+        engine.close()
+        for exclude in excludes:
+            exclude.close()
+        if download_index is not None:
+            download_index.close()
 
-print "INFO: Downloading file list"
-r = requests.get(FILES_ENDPOINT, params=params)
-if not r.status_code == 200:
-    print "ERROR: Something went wrong when downloading file list. Server says:"
-    print r.text
-    sys.exit()
-
-data = r.json()["data"]
-if len(data["hits"]) == 0:
-    print "No files matching the query. Exiting."
-    sys.exit()
-file_ids = []
-print "INFO: File list:"
-for hit in data["hits"]:
-    print "%s --> %s" % (hit["file_id"], hit["file_name"])
-    file_ids.append(hit["file_id"])
-print "INFO: Done downloading file list"
-
-# Download manifest
-print "INFO: Downloading manifest file"
-manifest_params = {"ids": file_ids}
-rr = requests.post(MANIFEST_ENDPOINT, data=json.dumps(manifest_params), headers={"content-type":"application/json"})
-if not rr.status_code == 200:
-    print "ERROR: Something went wrong when downloading manifest. Server says:"
-    print rr.text
-    sys.exit()
-
-# Save manifest. Create output directory if it doens't exist
-try:
-    os.makedirs(os.path.dirname(args["output_file"]))
-except OSError:
-    if not os.path.isdir(os.path.dirname(args["output_file"])):
-        print "ERROR: Could not create output directory %s" % os.path.dirname(args["output_file"])
-        print "..so here's the manifest in text:"
-        print rr.text
-        print "..and here's the error message:"
-        raise
-with open(args["output_file"], "wb") as manifest_out:
-    manifest_out.write(rr.text)
+    if counts["files"] == 0:
+        print "No files matching the query. Exiting."
+        sys.exit()
+    if counts["duplicates"] > 0:
+        print "INFO: Skipped %d duplicate file(s)" % counts["duplicates"]
+    if counts["excluded"] > 0:
+        print "INFO: Skipped %d excluded file(s)" % counts["excluded"]
+    if counts["downloaded"] > 0:
+        print "INFO: Skipped %d file(s) that are already downloaded" % counts["downloaded"]
+    print "INFO: Done downloading file list (%d files)" % counts["files"]
     print "INFO: Manifest written to %s" % args["output_file"]
 
+if __name__ == "__main__":
+    main()
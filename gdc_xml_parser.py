@@ -3,66 +3,124 @@ import datetime
 import sys
 import os
 import argparse
-import pandas as pd
-import xml.etree.ElementTree as ET
+import csv
+import json
+import hashlib
+import sqlite3
+import gdc_metrics
 
-def read_xml(xml_filepath):
+# Use lxml if it's installed, it's faster on large files
+try:
+    from lxml import etree as ET
+    HAVE_LXML = True
+except ImportError:
+    import xml.etree.cElementTree as ET
+    HAVE_LXML = False
+
+# Tags to keep
+TAGS_TO_KEEP = [
+    "age_at_initial_pathologic_diagnosis",
+    "bcr_patient_uuid",
+    "days_to_birth",
+    "days_to_death",
+    "days_to_initial_pathologic_diagnosis",
+    "days_to_last_followup",
+    "diagnosis",
+    "disease_code",
+    "file_uuid",
+    "gender",
+    "histological_type",
+    "pathologic_M",
+    "pathologic_N",
+    "pathologic_T",
+    "pathologic_stage",
+    "patient_id",
+    "vital_status",
+]
+
+# Columns of the output, i.e. the tags we keep and the calculated survival, in alphabetical order
+COLUMNS = sorted(TAGS_TO_KEEP + ["survival_in_days"])
+
+# Column types for the columnar output formats. Other columns are written as strings.
+INT_COLUMNS = [
+    "age_at_initial_pathologic_diagnosis",
+    "days_to_birth",
+    "days_to_death",
+    "days_to_initial_pathologic_diagnosis",
+    "days_to_last_followup",
+    "survival_in_days",
+]
+CATEGORICAL_COLUMNS = [
+    "disease_code",
+    "gender",
+    "histological_type",
+    "pathologic_M",
+    "pathologic_N",
+    "pathologic_T",
+    "pathologic_stage",
+    "vital_status",
+]
+
+# Version of the records in the parse cache. Bump it when read_xml extracts values differently,
+# so records cached by an older version are parsed again.
+PARSE_CACHE_VERSION = 1
+
+OUTPUT_FORMATS = ["tsv", "parquet", "feather"]
+
+def extract_tags(xml_file, tags):
     """
-    Takes a path to an xml file and returns the content as a dictionary.
-    (Tag-hierarchy will be lost in the process)
+    Stream through an xml file with iterparse and return a dictionary with key/value
+    tag/list of texts, for the wanted tags only. Namespaces are stripped from tag names.
+    Finished elements are cleared as we go, so memory use doesn't grow with file size.
     """
+    data_dict = {}
+    root = None
+    depth = 0
+    for event, elem in ET.iterparse(xml_file, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
 
-    ###############################################
-    ################# TESTING #####################
-    ###############################################
+        # Skip comments and processing instructions (lxml)
+        tag = elem.tag
+        if not isinstance(tag, basestring):
+            continue
 
-    # Data dictionary
-    data_dict = {}
+        # Strip namespace, i.e. {http://...}tag
+        if "}" in tag:
+            tag = tag.split("}", 1)[1]
 
-    # Parse xml
-    with open(xml_filepath, "ra") as f:
-        for line in f.readlines():
-            # Strip whitespace before and after
-            line = line.strip()
-            # Skip close-tags and one-liners (i.e. empty open tags)
-            if line.strip().startswith("</") or line.strip().endswith("/>"):
-                continue
+        # Store data. Elements without text (e.g. xsi:nil) are skipped, and text spanning
+        # multiple lines is collapsed to a single line
+        if tag in tags and elem.text:
+            text = " ".join(elem.text.split())
+            if text:
+                if tag not in data_dict:
+                    data_dict[tag] = []
+                data_dict[tag].append(text)
 
-            # Skip lines that are open tags without content (i.e. tags with no <X>Y</X>)
-            if "</" not in line.strip():
-                continue
+        # Free finished subtrees
+        elem.clear()
+        if depth == 1:
+            root.clear()
+        elif HAVE_LXML:
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
 
-            # Find tag
-            tag = line.split(":")[1].split(" ")[0]
-
-            # Find text
-            text = line.split(">")[1].split("<")[0]
-
-            # Store data
-            if tag not in data_dict.keys():
-                data_dict[tag] = []
-            data_dict[tag].append(text)
-
-    # Tags to keep
-    tags_to_keep = [
-        "age_at_initial_pathologic_diagnosis",
-        "bcr_patient_uuid",
-        "days_to_birth",
-        "days_to_death",
-        "days_to_initial_pathologic_diagnosis",
-        "days_to_last_followup",
-        "diagnosis",
-        "disease_code",
-        "file_uuid",
-        "gender",
-        "histological_type",
-        "pathologic_M",
-        "pathologic_N",
-        "pathologic_T",
-        "pathologic_stage",
-        "patient_id",
-        "vital_status",
-    ]
+    return data_dict
+
+def read_xml(xml_filepath):
+    """
+    Takes a path to an xml file, or an open file object, and returns the patient data as
+    a tuple of values in COLUMNS order. (Tag-hierarchy will be lost in the process)
+    """
+
+    # Parse xml, keeping only the tags we need
+    tags_to_keep = TAGS_TO_KEEP
+    data_dict = extract_tags(xml_filepath, set(tags_to_keep))
 
     patient_data = {}
     # Keep only specified tags
@@ -77,6 +135,8 @@ def read_xml(xml_filepath):
         # print "%s --> %s" % (key, value)
 
     # Check vital_status
+    if not patient_data["vital_status"]:
+        raise ValueError("No vital_status")
     if len(patient_data["vital_status"]) > 1:
         if "dead" in [x.lower() for x in patient_data["vital_status"]]:
             patient_data["vital_status"] = ["dead"]
@@ -98,95 +158,348 @@ def read_xml(xml_filepath):
             patient_data["days_to_last_followup"] = [int(patient_data["days_to_last_followup"][0])]
 
     # Calculate survival in days
-    alive = patient_data["vital_status"][0] == "alive"
+    alive = patient_data["vital_status"][0].lower() == "alive"
 
     if alive:
         if not patient_data["days_to_last_followup"]:
-            print "Error: Patient is alive, but no days_to_last_followup. Exiting."
-            sys.exit()
+            raise ValueError("Patient is alive, but no days_to_last_followup")
         days_to_last_followup = patient_data["days_to_last_followup"][0]
         patient_data["survival_in_days"] = [days_to_last_followup]
     else:
         if not patient_data["days_to_death"]:
-            print "Error: Patient is dead, but no days_to_death. Exiting."
+            raise ValueError("Patient is dead, but no days_to_death")
         days_to_death = patient_data["days_to_death"][0]
         patient_data["survival_in_days"] = [days_to_death]
 
-    # Prepare dictionary for dataframe conversion
-    for key, value in patient_data.items():
-        # Replace None entries
-        if not patient_data[key]:
-            patient_data[key] = ["null"]
-        else:
-            # Turn non-lists into lists
-            if not isinstance(value, list):
-                patient_data[key] = [value]
-
-        # Check length of values. All have to be the same size, and the size has to be 1.
-        if value and len(value) > 1:
+    # Build the record in column order. Missing values are written as null, and only the
+    # first entry is kept for tags with more than one value
+    record = []
+    for key in COLUMNS:
+        value = patient_data[key]
+        if not value:
+            record.append("null")
+            continue
+        if len(value) > 1:
             print "WARNING: Value list with more than 1 entry:"
             print "%s --> %s" % (key, value)
             print "Warning: Keeping only first entry (%s) disregarding everything else." % (value[0])
-            patient_data[key] = [value[0]]
+        record.append(value[0])
+
+    return tuple(record)
+
+def write_tsv(records, output_filepath):
+    """
+    Write patient records to a TSV file as they come in, with COLUMNS as header.
+    Returns the number of records written.
+    """
+    num_records = 0
+    with open(output_filepath, "wb") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(COLUMNS)
+        for record in records:
+            writer.writerow([v.encode("utf-8") if isinstance(v, unicode) else v for v in record])
+            num_records += 1
+    return num_records
+
+def arrow_schema():
+    """
+    Return the pyarrow schema of the columnar output formats
+    """
+    import pyarrow as pa
+
+    fields = []
+    for name in COLUMNS:
+        if name in INT_COLUMNS:
+            fields.append(pa.field(name, pa.int64()))
+        elif name in CATEGORICAL_COLUMNS:
+            fields.append(pa.field(name, pa.dictionary(pa.int32(), pa.string())))
+        else:
+            fields.append(pa.field(name, pa.string()))
+    return pa.schema(fields)
+
+def records_to_table(records, schema):
+    """
+    Turn a list of patient records into a typed pyarrow table. Null values become real
+    nulls, ints become int64 and categoricals are dictionary encoded.
+    """
+    import pyarrow as pa
+
+    columns = zip(*records) if records else [()] * len(COLUMNS)
+    arrays = []
+    for name, values in zip(COLUMNS, columns):
+        values = [None if v == "null" else v for v in values]
+        if name in INT_COLUMNS:
+            arrays.append(pa.array([None if v is None else int(v) for v in values], type=pa.int64()))
+        elif name in CATEGORICAL_COLUMNS:
+            arrays.append(pa.array(values, type=pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(values, type=pa.string()))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+def write_feather(table, output_filepath):
+    """
+    Write a pyarrow table to a Feather file that pyarrow.feather.read_feather and
+    pandas.read_feather can read. The pyarrow versions that run on Python 2 only write
+    Feather from a pandas DataFrame, which would turn int columns with nulls into floats,
+    so the columns are written with the Feather writer it uses underneath. Newer pyarrow
+    versions write tables directly.
+    """
+    import pyarrow as pa
+    import pyarrow.feather
 
-    # Read patient dict as Dataframe
+    FeatherWriter = getattr(pa.lib, "FeatherWriter", None)
+    if FeatherWriter is None:
+        pyarrow.feather.write_feather(table, output_filepath)
+        return
+    writer = FeatherWriter()
+    writer.open(output_filepath)
+    for name, column in zip(table.schema.names, table.columns):
+        writer.write_array(name, column.chunk(0) if column.num_chunks == 1 else pa.concat_arrays(column.chunks))
+    writer.close()
+
+def write_columnar(records, output_filepath, output_format, row_group_size=100000):
+    """
+    Write patient records to a Parquet or Feather file with typed columns. Parquet is
+    written one row group of row_group_size records at a time, so memory use doesn't grow
+    with the number of records. Feather files have no row groups, so records are
+    collected and written in one piece. Returns the number of records written.
+    """
     try:
-        patient_df = pd.DataFrame.from_dict(patient_data)
-    except ValueError as e:
-        print "Something went wrong with the current dictionary:"
-        for key, value in patient_data.items():
-            print "%s --> %s" % (key, value)
-        print "\nError message:"
-        print e
+        import pyarrow as pa
+    except ImportError:
+        print "Error: Writing %s files requires pyarrow (pip install pyarrow). Exiting." % output_format
         sys.exit()
-    # Write df to file
-    # patient_df.to_csv("patient_data.tsv", sep="\t", index=False)
 
-    return patient_df
+    schema = arrow_schema()
+    num_records = 0
+    if output_format == "parquet":
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(output_filepath, schema)
+        batch = []
+        for record in records:
+            batch.append(record)
+            num_records += 1
+            if len(batch) == row_group_size:
+                writer.write_table(records_to_table(batch, schema))
+                batch = []
+        if batch or num_records == 0:
+            writer.write_table(records_to_table(batch, schema))
+        writer.close()
+    else:
+        batch = list(records)
+        num_records = len(batch)
+        write_feather(records_to_table(batch, schema), output_filepath)
+    return num_records
 
-    ###############################################
-    ################ END TESTING ##################
-    ###############################################
+def write_records(records, output_filepath, output_format="tsv", row_group_size=100000):
+    """
+    Write patient records to output_filepath in one of OUTPUT_FORMATS.
+    Returns the number of records written.
+    """
+    if output_format == "tsv":
+        return write_tsv(records, output_filepath)
+    return write_columnar(records, output_filepath, output_format, row_group_size)
 
+def parse_file(xml_filepath):
+    """
+    Parse a single xml file, catching any error so one bad file doesn't stop the whole run.
+    Returns a tuple of (xml_filepath, patient record, error message).
+    """
+    try:
+        return xml_filepath, read_xml(xml_filepath), None
+    except Exception as e:
+        return xml_filepath, None, "%s: %s" % (type(e).__name__, e)
 
-# Setup and handle arguments
-parser = argparse.ArgumentParser()
-parser.add_argument("-i", "--input-dir", help="Path to input directory, typically directory containing clinical data from TCGA in xml-format. Required.", required=True)
-parser.add_argument("-o", "--output-file", help="Path to output file. Directories will be created if necessary, and existing files will be overwritten. Not required. Default: ./tcga_clinical_data.tsv", required=False, default=os.path.join(os.getcwd(), "tcga_clinical_data.tsv"))
+def parse_files(xml_filepaths, jobs=1):
+    """
+    Parse xml files, in parallel on a pool of jobs processes if jobs > 1. Files are handed
+    to the workers in chunks, and results are yielded in the same order as xml_filepaths.
+    """
+    if jobs <= 1 or len(xml_filepaths) <= 1:
+        for xml_filepath in xml_filepaths:
+            yield parse_file(xml_filepath)
+        return
 
-# Check if enough arguments have been provided
-if len(sys.argv) < 2:
-    print "Too few arguments provided."
-    parser.print_help()
+    # Only pay for importing multiprocessing when it's used
+    import multiprocessing
 
-args = parser.parse_args()
-input_dirpath = args.input_dir
-output_filepath = args.output_file
+    # A few chunks per worker keeps the overhead low while balancing the load
+    chunksize = max(1, len(xml_filepaths) / (jobs * 4))
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap(parse_file, xml_filepaths, chunksize):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def file_hash(filepath):
+    """
+    Return the SHA-1 hex digest of a file's content
+    """
+    sha1 = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), ""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+class ParseCache(object):
+    """
+    On-disk SQLite cache of parsed patient records, keyed on absolute file path and
+    validated against mtime/size and content hash. Records are stored as tuples in COLUMNS
+    order, so the cache is cleared if it was written with other columns or by another
+    PARSE_CACHE_VERSION.
+    """
 
-# Validate input path
-if not os.path.exists(input_dirpath):
-    print "Error: Provided input directory (%s) does not seem to exist." % input_dirpath
-    sys.exit()
+    def __init__(self, cache_filepath):
+        self.conn = sqlite3.connect(cache_filepath)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS records (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, sha1 TEXT, record TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS schema (key TEXT PRIMARY KEY, value TEXT)")
+        schema = {"version": str(PARSE_CACHE_VERSION), "columns": json.dumps(COLUMNS)}
+        if dict(self.conn.execute("SELECT key, value FROM schema")) != schema:
+            num_records = self.conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+            if num_records > 0:
+                print "Parse cache was written with other columns or by another version, clearing %d cached record(s)" % num_records
+            self.conn.execute("DELETE FROM records")
+            self.conn.execute("DELETE FROM schema")
+            self.conn.executemany("INSERT INTO schema (key, value) VALUES (?, ?)", schema.items())
+        self.conn.commit()
 
-# Loop xml-files in the provided directory
-xml_filepaths = []
-for root, dirs, files in os.walk(input_dirpath):
-    for f in files:
-        if f.endswith(".xml"):
-            xml_filepaths.append(os.path.join(root, f))
+    def parse_files(self, xml_filepaths, jobs=1):
+        """
+        Same as parse_files, but only files that are new or changed since they were cached
+        are parsed. A file with a new mtime but unchanged content hash is not re-parsed.
+        Cached files that are no longer in xml_filepaths are evicted. Results are yielded in
+        the same order as xml_filepaths.
+        """
+        cached = {}
+        for path, mtime, size, sha1, record in self.conn.execute("SELECT path, mtime, size, sha1, record FROM records"):
+            cached[path] = (mtime, size, sha1, record)
 
-print "Found the following xml-files:"
-for f in xml_filepaths:
-    print f
+        records = {}
+        to_parse = []
+        for xml_filepath in xml_filepaths:
+            path = os.path.abspath(xml_filepath)
+            stat = os.stat(path)
+            entry = cached.pop(path, None)
+            if entry is not None and entry[1] == stat.st_size:
+                if entry[0] == stat.st_mtime:
+                    records[xml_filepath] = tuple(json.loads(entry[3]))
+                    continue
+                # Touched, but possibly not changed
+                if entry[2] == file_hash(path):
+                    self.conn.execute("UPDATE records SET mtime = ? WHERE path = ?", (stat.st_mtime, path))
+                    records[xml_filepath] = tuple(json.loads(entry[3]))
+                    continue
+            to_parse.append(xml_filepath)
+
+        # Whatever is left in the cache has been deleted
+        if len(cached) > 0:
+            print "Evicting %d deleted xml-file(s) from cache" % len(cached)
+            self.conn.executemany("DELETE FROM records WHERE path = ?", [(path,) for path in cached])
+        print "Using %d cached xml-file(s), parsing %d new or changed xml-file(s)" % (len(records), len(to_parse))
+        gdc_metrics.count("parse_cache_hits", len(records))
+
+        # Parse new and changed files and store them in the cache. Failed files are not cached.
+        errors = {}
+        for xml_filepath, record, error in parse_files(to_parse, jobs):
+            if error is not None:
+                errors[xml_filepath] = error
+                continue
+            path = os.path.abspath(xml_filepath)
+            stat = os.stat(path)
+            self.conn.execute("INSERT OR REPLACE INTO records (path, mtime, size, sha1, record) VALUES (?, ?, ?, ?, ?)",
+                              (path, stat.st_mtime, stat.st_size, file_hash(path), json.dumps(record)))
+            records[xml_filepath] = record
+        self.conn.commit()
+
+        for xml_filepath in xml_filepaths:
+            if xml_filepath in errors:
+                yield xml_filepath, None, errors[xml_filepath]
+            else:
+                yield xml_filepath, records[xml_filepath], None
+
+    def close(self):
+        self.conn.close()
+
+def find_xml_files(input_dirpath):
+    """
+    Return the paths of all xml-files in a directory and its subdirectories
+    """
+    xml_filepaths = []
+    for root, dirs, files in os.walk(input_dirpath):
+        for f in files:
+            if f.endswith(".xml"):
+                xml_filepaths.append(os.path.join(root, f))
+    return xml_filepaths
+
+@gdc_metrics.instrumented("gdc_xml_parser")
+def main(argv=None):
+    # Setup and handle arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--input-dir", help="Path to input directory, typically directory containing clinical data from TCGA in xml-format. Required.", required=True)
+    parser.add_argument("-o", "--output-file", help="Path to output file. Directories will be created if necessary, and existing files will be overwritten. Not required. Default: ./tcga_clinical_data.tsv", required=False, default=os.path.join(os.getcwd(), "tcga_clinical_data.tsv"))
+    parser.add_argument("-j", "--jobs", help="Number of processes to parse xml-files with. Default: 1", type=int, required=False, default=1)
+    parser.add_argument("-f", "--format", help="Output format, one of %s. Parquet and Feather files have typed columns and require pyarrow. Default: tsv" % ", ".join(OUTPUT_FORMATS), choices=OUTPUT_FORMATS, required=False, default="tsv")
+    parser.add_argument("--row-group-size", help="Number of patients per Parquet row group. Default: 100000", type=int, required=False, default=100000)
+    parser.add_argument("-c", "--cache-file", help="Path to a cache file (SQLite) of parsed xml-files. Only new or changed xml-files are parsed, and deleted ones are removed from the cache. Use one cache file per input directory. Not required.", required=False)
+    gdc_metrics.add_metrics_arguments(parser)
+
+    # Check if enough arguments have been provided
+    if len(sys.argv[1:] if argv is None else argv) < 1:
+        print "Too few arguments provided."
+        parser.print_help()
+
+    args = parser.parse_args(argv)
+    gdc_metrics.start_from_args(args)
+    input_dirpath = args.input_dir
+    output_filepath = args.output_file
+
+    # Validate input path
+    if not os.path.exists(input_dirpath):
+        print "Error: Provided input directory (%s) does not seem to exist." % input_dirpath
+        sys.exit()
+
+    # Loop xml-files in the provided directory
+    with gdc_metrics.stage("find_files") as stage:
+        xml_filepaths = find_xml_files(input_dirpath)
+        stage.add(len(xml_filepaths))
+
+    print "Found the following xml-files:"
+    for f in xml_filepaths:
+        print f
+
+    # Parse xml-files and stream the records to the output file, skipping the ones that fail
+    cache = ParseCache(args.cache_file) if args.cache_file else None
+    if cache:
+        results = cache.parse_files(xml_filepaths, args.jobs)
+    else:
+        results = parse_files(xml_filepaths, args.jobs)
+    failed = []
+    def records():
+        for input_filepath, record, error in results:
+            parse_stage.add()
+            if error is not None:
+                print "Error: Could not parse %s (%s). Skipping." % (input_filepath, error)
+                failed.append(input_filepath)
+                continue
+            yield record
 
-patient_dfs = []
-for input_filepath in xml_filepaths:
-    # Parse xml-file
-    patient_dfs.append(read_xml(input_filepath))
+    # Records are written as they are parsed, so the parse stage includes writing
+    print "Writing file to %s" % output_filepath
+    with gdc_metrics.stage("parse") as parse_stage:
+        num_records = write_records(records(), output_filepath, args.format, args.row_group_size)
+    if cache:
+        cache.close()
 
-# Create one Dataframe containing data from all the dataframes
-main_df = pd.concat(patient_dfs)
-# Write that to file
-print "Writing file to %s" % output_filepath
-main_df.to_csv(output_filepath, sep="\t", index=False)
+    if len(failed) > 0:
+        print "Warning: %d of %d xml-files could not be parsed:" % (len(failed), len(xml_filepaths))
+        for f in failed:
+            print f
+    print "Wrote %d patients to %s" % (num_records, output_filepath)
 
+if __name__ == "__main__":
+    main()